@@ -0,0 +1,130 @@
+import re
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+from .connection import DatabaseManager, ResourceConfig
+
+QUERY_PREVIEW = "preview"
+QUERY_COUNT = "count"
+QUERY_AGGREGATE = "aggregate"
+QUERY_EXPORT = "export"
+QUERY_REFRESH = "refresh"
+
+# Kinds that may scan and return the full filtered table, or bulk-load from it
+HEAVY_QUERIES = {QUERY_EXPORT, QUERY_REFRESH}
+
+_COUNT_PATTERN = re.compile(r"^\s*SELECT\s+COUNT\s*\(", re.IGNORECASE)
+_LIMIT_PATTERN = re.compile(r"\bLIMIT\s+\d+\s*;?\s*$", re.IGNORECASE)
+
+
+class AdmissionRejected(RuntimeError):
+    """Raised when a heavy query cannot be admitted"""
+
+
+class AdmissionController:
+    """
+    Caps how many heavy queries run at once so previews stay fast.
+
+    Previews, counts and aggregates are always admitted. Heavy queries (full
+    exports, rollup refreshes) take one of max_heavy_queries slots; the rest
+    wait in line, up to max_queued_queries waiting and queue_timeout seconds
+    each.
+    """
+
+    _instance: Optional["AdmissionController"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        max_heavy_queries: int = 2,
+        max_queued_queries: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+    ):
+        self.max_heavy_queries = max_heavy_queries
+        self.max_queued_queries = max_queued_queries
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_heavy_queries)
+        self._lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+
+    @classmethod
+    def instance(cls, config_file: str = "config.toml") -> "AdmissionController":
+        with cls._instance_lock:
+            if cls._instance is None:
+                resources = ResourceConfig(DatabaseManager(config_file).config)
+                cls._instance = cls(
+                    resources.max_heavy_queries,
+                    resources.max_queued_queries,
+                    resources.queue_timeout,
+                )
+            return cls._instance
+
+    @staticmethod
+    def classify(query: str) -> str:
+        """
+        Guess the kind of a QueryBuilder query from its SQL text.
+
+        Returns:
+            str: QUERY_COUNT for build_count(), QUERY_PREVIEW for a limited
+                build_select(), QUERY_EXPORT otherwise
+        """
+        if _COUNT_PATTERN.match(query):
+            return QUERY_COUNT
+        if _LIMIT_PATTERN.search(query):
+            return QUERY_PREVIEW
+        return QUERY_EXPORT
+
+    def acquire(self, kind: str) -> bool:
+        """
+        Take a slot for a query of the given kind, waiting if needed.
+
+        Returns:
+            bool: True if a heavy slot was taken and must be released
+        """
+        if kind not in HEAVY_QUERIES:
+            return False
+
+        # The queue limit only applies to queries that would have to wait
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if (
+                    self.max_queued_queries is not None
+                    and self.waiting >= self.max_queued_queries
+                ):
+                    raise AdmissionRejected(
+                        f"Too many heavy queries waiting ({self.waiting}), try again later"
+                    )
+                self.waiting += 1
+            try:
+                admitted = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not admitted:
+                raise AdmissionRejected(
+                    f"Timed out after {self.queue_timeout}s waiting for a heavy query slot"
+                )
+        with self._lock:
+            self.running += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.running -= 1
+        self._slots.release()
+
+    @contextmanager
+    def admit(self, kind: str):
+        """Context manager holding an admission slot for the duration of a query"""
+        held = self.acquire(kind)
+        try:
+            yield
+        finally:
+            if held:
+                self.release()
+
+
+def get_admission_controller() -> AdmissionController:
+    return AdmissionController.instance("config.toml")
@@ -0,0 +1,65 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRebuild:
+    """
+    Runs a rebuild on a daemon thread, at most one at a time.
+
+    Callers poll start() on every request, so after a failure it does
+    nothing for retry_interval seconds instead of restarting a heavy
+    rebuild against a source that is down.
+
+    Example:
+        rebuild = BackgroundRebuild("typeahead-NPWP", build, retry_interval=300)
+        rebuild.start()
+    """
+
+    def __init__(
+        self, name: str, target: Callable[[], object], retry_interval: float = 300
+    ):
+        self.name = name
+        self.target = target
+        self.retry_interval = retry_interval
+        self.running = False
+        self.error: Optional[str] = None
+        self.failed_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def backing_off(self) -> bool:
+        """Whether the last run failed less than retry_interval seconds ago"""
+        return (
+            self.failed_at is not None
+            and time.time() - self.failed_at < self.retry_interval
+        )
+
+    def start(self) -> bool:
+        """
+        Start the rebuild unless one is running or backing off.
+
+        Returns:
+            bool: Whether a rebuild was started
+        """
+        with self._lock:
+            if self.running or self.backing_off():
+                return False
+            self.running = True
+        threading.Thread(target=self._run, name=self.name, daemon=True).start()
+        return True
+
+    def _run(self):
+        try:
+            self.target()
+            self.error, self.failed_at = None, None
+        except Exception as e:
+            logger.exception(
+                "%s failed, retrying in %gs", self.name, self.retry_interval
+            )
+            self.error, self.failed_at = str(e), time.time()
+        finally:
+            with self._lock:
+                self.running = False
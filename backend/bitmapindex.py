@@ -0,0 +1,598 @@
+import bisect
+import datetime
+import logging
+import os
+import shutil
+import threading
+import time
+from functools import reduce
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from .admission import QUERY_AGGREGATE, QUERY_PREVIEW, QUERY_REFRESH
+from .background import BackgroundRebuild
+from .connection import DatabaseManager
+from .executor import QueryExecutor
+from .exporters import export_query
+from .querybuilder import QueryBuilder
+
+ROW_ID = "__row_id"
+# A value matching fewer than 1 in SPARSE_RATIO rows keeps its 32-bit row
+# ids, which is then smaller than a bit per snapshot row
+SPARSE_RATIO = 32
+_BITMAP_OPERATORS = {"", "=", "IN"}
+
+logger = logging.getLogger(__name__)
+
+
+class BitmapConfig:
+    def __init__(self, config):
+        bitmap = config.get("bitmap", {})
+        db = config["db"]
+        self.enabled = bool(bitmap.get("enabled", False))
+        self.directory = Path(bitmap.get("directory", "data/bitmap"))
+        self.source_table = bitmap.get(
+            "source_table", f"db.{db['schema']}.{db['database']}"
+        )
+        self.date_column = bitmap.get("date_column", "DATEBAYAR")
+        self.columns = list(
+            bitmap.get(
+                "columns",
+                [
+                    column
+                    for column, column_type in config.get("filters_types", {}).items()
+                    if column_type == "string"
+                ],
+            )
+        )
+        self.max_values = int(bitmap.get("max_values", 1000))
+        self.refresh_interval = float(bitmap.get("refresh_interval", 3600))
+        self.retry_interval = float(bitmap.get("retry_interval", 300))
+        self.build_timeout = float(bitmap.get("build_timeout", 6 * 3600))
+
+
+class Selection:
+    """
+    The snapshot rows matching a set of filters: the row range [start, stop)
+    left by the date filter, narrowed when other filters apply either by
+    mask, one bit per row of the range, or by ids, the sorted matching row
+    ids.
+    """
+
+    def __init__(
+        self,
+        start: int,
+        stop: int,
+        mask: Optional[pa.BooleanArray] = None,
+        ids: Optional[pa.Int64Array] = None,
+    ):
+        self.start = start
+        self.stop = max(start, stop)
+        self.mask = mask
+        self.ids = ids
+
+    def count(self) -> int:
+        if self.ids is not None:
+            return len(self.ids)
+        if self.mask is None:
+            return self.stop - self.start
+        return pc.sum(self.mask).as_py() or 0
+
+    def row_ids(self, limit: Optional[int] = None) -> pa.Array:
+        """Matching row ids in ascending order, at most limit of them"""
+        if self.ids is not None:
+            ids = self.ids
+        elif self.mask is None:
+            stop = self.stop if limit is None else min(self.stop, self.start + limit)
+            return pa.array(range(self.start, stop), pa.int64())
+        else:
+            ids = pc.add(pc.indices_nonzero(self.mask).cast(pa.int64()), self.start)
+        return ids if limit is None else ids.slice(0, limit)
+
+
+def _sorted(ids: pa.Array) -> pa.Array:
+    return pc.take(ids, pc.array_sort_indices(ids))
+
+
+def _intersect(a, b, start: int):
+    """AND two column results, each ("mask", BooleanArray) or ("ids", Int64Array)"""
+    (a_kind, a_rows), (b_kind, b_rows) = sorted([a, b], key=lambda r: r[0] != "ids")
+    if a_kind == "mask":
+        return "mask", pc.and_(a_rows, b_rows)
+    if b_kind == "mask":
+        return "ids", pc.filter(a_rows, pc.take(b_rows, pc.subtract(a_rows, start)))
+    if len(a_rows) > len(b_rows):
+        a_rows, b_rows = b_rows, a_rows
+    # Hash the smaller side, filtering keeps the larger side sorted
+    return "ids", pc.filter(b_rows, pc.is_in(b_rows, value_set=a_rows))
+
+
+class BitmapIndex:
+    """
+    Matching rows per (column, value) and row offsets per day over a
+    snapshot sorted by the date column.
+
+    Like a roaring bitmap, each value is held in the smaller of two forms: a
+    BooleanArray with a bit per snapshot row for frequent values, or the
+    sorted uint32 row ids for values on fewer than 1 in SPARSE_RATIO rows.
+    A column thus costs at most about 4 bytes per row for its rare values
+    plus a bit per row for each of its (at most SPARSE_RATIO) frequent ones.
+
+    Because the snapshot is sorted by date, a date range is a contiguous row
+    range found by binary search over the days, and only that slice of the
+    value sets is combined: OR within a column's IN list, AND across
+    columns.
+    """
+
+    def __init__(
+        self,
+        rows: int,
+        bitmaps: Dict[str, Dict[str, pa.Array]],
+        days: pa.Table,
+        date_column: str = "DATEBAYAR",
+    ):
+        self.rows = rows
+        self.bitmaps = bitmaps
+        self.date_column = date_column
+        self.days = days.column("day").to_pylist()
+        self.day_starts = days.column("start").to_pylist()
+        # First row of the day stamped after midnight, for inclusive upper bounds
+        self.day_after_midnight = days.column("after_midnight").to_pylist()
+        self.dated_rows = days.column("stop").to_pylist()[-1] if self.days else 0
+
+    @classmethod
+    def from_tables(
+        cls, bitmaps: pa.Table, days: pa.Table, date_column: str = "DATEBAYAR"
+    ) -> "BitmapIndex":
+        rows = int(bitmaps.schema.metadata[b"rows"])
+        by_column = {}
+        for column, value, row_ids, bits in zip(
+            bitmaps.column("column").to_pylist(),
+            bitmaps.column("value").to_pylist(),
+            bitmaps.column("row_ids").combine_chunks(),
+            bitmaps.column("bits").combine_chunks(),
+        ):
+            if bits.is_valid:
+                rows_of_value = pa.Array.from_buffers(
+                    pa.bool_(), rows, [None, bits.as_buffer()]
+                )
+            else:
+                rows_of_value = row_ids.values
+            by_column.setdefault(column, {})[value] = rows_of_value
+        return cls(rows, by_column, days, date_column)
+
+    def nbytes(self) -> int:
+        """Memory held by the value sets"""
+        return sum(
+            rows.nbytes for values in self.bitmaps.values() for rows in values.values()
+        )
+
+    def _first_row_from(self, day: datetime.date) -> int:
+        i = bisect.bisect_left(self.days, day)
+        return self.day_starts[i] if i < len(self.days) else self.dated_rows
+
+    def _date_range(self, value) -> Optional[tuple[int, int]]:
+        """Row range for QueryBuilder's BETWEEN on the date column"""
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            return None
+        bounds = []
+        for bound in value:
+            try:
+                bound = datetime.datetime.fromisoformat(str(bound))
+            except ValueError:
+                return None
+            if bound.time() != datetime.time(0):
+                return None
+            bounds.append(bound.date())
+        first, last = bounds
+
+        start = self._first_row_from(first)
+        i = bisect.bisect_left(self.days, last)
+        if i < len(self.days) and self.days[i] == last:
+            stop = self.day_after_midnight[i]
+        else:
+            stop = self._first_row_from(last)
+        return start, stop
+
+    def resolve(self, filters) -> Optional[Selection]:
+        """
+        Resolve QueryBuilder filters to the matching rows.
+
+        Args:
+            filters: A QueryBuilder or its filters list
+
+        Returns:
+            Selection: The matching rows, or None if a filter cannot be
+                answered from the index (the caller should query instead)
+        """
+        if isinstance(filters, QueryBuilder):
+            filters = filters.filters
+
+        start, stop = 0, self.rows
+        value_filters = []
+        for f in filters:
+            column = str(f["column"]).strip('"')
+            operator = str(f["operator"]).upper()
+            if column == self.date_column and f["type"] == "datetime":
+                date_range = self._date_range(f["value"])
+                if date_range is None:
+                    return None
+                start, stop = max(start, date_range[0]), min(stop, date_range[1])
+            elif (
+                f["type"] == "string"
+                and column in self.bitmaps
+                and operator in _BITMAP_OPERATORS
+            ):
+                values = f["value"] if isinstance(f["value"], list) else [f["value"]]
+                value_filters.append((column, [str(value) for value in values]))
+            else:
+                return None
+
+        if start >= stop:
+            return Selection(start, start)
+        matched = None
+        for column, values in value_filters:
+            rows = [
+                self.bitmaps[column][value]
+                for value in dict.fromkeys(values)
+                if value in self.bitmaps[column]
+            ]
+            if not rows:
+                return Selection(start, start)
+            column_rows = self._union(rows, start, stop)
+            matched = (
+                column_rows
+                if matched is None
+                else _intersect(matched, column_rows, start)
+            )
+        if matched is None:
+            return Selection(start, stop)
+        kind, rows = matched
+        if kind == "ids":
+            return Selection(start, stop, ids=rows)
+        return Selection(start, stop, mask=rows)
+
+    @staticmethod
+    def _union(rows: List[pa.Array], start: int, stop: int):
+        """OR the value sets of one column over [start, stop)"""
+        masks = [r.slice(start, stop - start) for r in rows if r.type == pa.bool_()]
+        id_lists = []
+        for r in rows:
+            if r.type != pa.bool_():
+                lo = bisect.bisect_left(r, start, key=lambda row: row.as_py())
+                hi = bisect.bisect_left(r, stop, key=lambda row: row.as_py())
+                id_lists.append(r.slice(lo, hi - lo).cast(pa.int64()))
+        if not id_lists:
+            return "mask", reduce(pc.or_, masks)
+        if masks:
+            ids = pc.indices_nonzero(reduce(pc.or_, masks)).cast(pa.int64())
+            id_lists.append(pc.add(ids, start))
+        # The values of a column are disjoint, so concatenating is the union
+        ids = pa.concat_arrays(id_lists)
+        return "ids", ids if len(id_lists) == 1 else _sorted(ids)
+
+
+class SnapshotIndex:
+    """
+    Optional local snapshot of the source table with a BitmapIndex over it.
+
+    The snapshot is a Parquet file sorted by the date column with a row id
+    column, so previews read only the row groups holding the first matching
+    rows. Counts and previews reflect the snapshot, which is rebuilt in the
+    background after refresh_interval seconds; until the first build has
+    finished, callers get None and should query the source table.
+
+    Processes sharing the directory take turns through a BUILDING lock
+    file: one builds, the others pick the new generation up from CURRENT.
+    """
+
+    _instance: Optional["SnapshotIndex"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, bitmap_config: BitmapConfig, executor: QueryExecutor = None):
+        self.config = bitmap_config
+        # The snapshot is versioned by its build, not the source data version
+        self.executor = executor or QueryExecutor(use_cache=False)
+        self.bitmap_index: Optional[BitmapIndex] = None
+        self.snapshot_path: Optional[Path] = None
+        self.built_at: Optional[float] = None
+        self._current_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.rebuild = BackgroundRebuild(
+            "bitmap-index", self.build, bitmap_config.retry_interval
+        )
+
+    @classmethod
+    def instance(cls, config_file: str = "config.toml") -> Optional["SnapshotIndex"]:
+        """The process-wide index, or None if [bitmap] is not enabled"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                bitmap_config = BitmapConfig(DatabaseManager(config_file).config)
+                if not bitmap_config.enabled:
+                    return None
+                cls._instance = cls(bitmap_config)
+            return cls._instance
+
+    @property
+    def columns(self) -> List[str]:
+        return self.config.columns
+
+    def _current_file(self) -> Path:
+        return self.config.directory / "CURRENT"
+
+    def _lock_file(self) -> Path:
+        return self.config.directory / "BUILDING"
+
+    def _acquire_build_lock(self) -> bool:
+        """
+        Claim the build for this process. The app and the service share the
+        directory, so one builds and the others reload CURRENT when it moves.
+        """
+        self.config.directory.mkdir(parents=True, exist_ok=True)
+        lock = self._lock_file()
+        try:
+            age = time.time() - lock.stat().st_mtime
+            if age < self.config.build_timeout:
+                return False
+            # Left behind by a builder that died; builds touch it as they go
+            lock.unlink(missing_ok=True)
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return True
+
+    def _building_elsewhere(self) -> bool:
+        try:
+            age = time.time() - self._lock_file().stat().st_mtime
+        except FileNotFoundError:
+            return False
+        return age < self.config.build_timeout and not self.rebuild.running
+
+    def _load(self) -> bool:
+        current = self._current_file()
+        try:
+            loaded_at = current.stat().st_mtime
+            generation = self.config.directory / current.read_text().strip()
+            index = BitmapIndex.from_tables(
+                pq.read_table(generation / "bitmaps.parquet"),
+                pq.read_table(generation / "days.parquet"),
+                self.config.date_column,
+            )
+        except (FileNotFoundError, KeyError):
+            # KeyError: written by an older version, rebuild it
+            return False
+        with self._lock:
+            self.bitmap_index = index
+            self.snapshot_path = generation / "snapshot.parquet"
+            self.built_at = loaded_at
+        return True
+
+    def build(self) -> Optional[BitmapIndex]:
+        """
+        Take a fresh snapshot of the source table and index it.
+
+        Returns:
+            BitmapIndex: The new index, or None if another process is
+                already building one
+        """
+        if not self._acquire_build_lock():
+            return None
+        try:
+            generation = f"{time.time_ns()}"
+            directory = self.config.directory / generation
+            directory.mkdir(parents=True, exist_ok=True)
+            try:
+                bitmaps, days = self._build_generation(directory)
+            except BaseException:
+                shutil.rmtree(directory, ignore_errors=True)
+                raise
+
+            current = self._current_file()
+            temp_current = current.with_name(f".{current.name}.part")
+            temp_current.write_text(generation)
+            temp_current.replace(current)
+            self._remove_old_generations(keep=generation)
+        finally:
+            self._lock_file().unlink(missing_ok=True)
+
+        index = BitmapIndex.from_tables(bitmaps, days, self.config.date_column)
+        with self._lock:
+            self.bitmap_index = index
+            self.snapshot_path = directory / "snapshot.parquet"
+            self.built_at = self._current_at = current.stat().st_mtime
+        return index
+
+    def _build_generation(self, directory: Path):
+        """Write the snapshot, bitmaps and days of one generation"""
+        snapshot = directory / "snapshot.parquet"
+        date_col = f'"{self.config.date_column}"'
+
+        with self.executor.admission.admit(QUERY_REFRESH):
+            export_query(
+                self.executor.cursor(),
+                f"""SELECT row_number() OVER (ORDER BY {date_col} NULLS LAST) - 1
+                        AS {ROW_ID}, *
+                    FROM {self.config.source_table}
+                    ORDER BY {ROW_ID}""",
+                [],
+                snapshot,
+                "parquet",
+            )
+        os.utime(self._lock_file())
+
+        snapshot_sql = f"read_parquet('{snapshot.as_posix()}')"
+        days = self.executor.fetch_arrow(
+            f"""SELECT CAST({date_col} AS DATE) AS day,
+                    MIN({ROW_ID}) AS start,
+                    COALESCE(
+                        MIN({ROW_ID}) FILTER (
+                            WHERE {date_col} > CAST(CAST({date_col} AS DATE) AS TIMESTAMP)
+                        ),
+                        MAX({ROW_ID}) + 1
+                    ) AS after_midnight,
+                    MAX({ROW_ID}) + 1 AS stop
+                FROM {snapshot_sql}
+                WHERE {date_col} IS NOT NULL
+                GROUP BY 1 ORDER BY 1""",
+            kind=QUERY_AGGREGATE,
+        )
+        bitmaps = self._build_bitmaps(snapshot)
+
+        pq.write_table(bitmaps, directory / "bitmaps.parquet", compression="zstd")
+        pq.write_table(days, directory / "days.parquet")
+        return bitmaps, days
+
+    def _build_bitmaps(self, snapshot: Path) -> pa.Table:
+        columns, values, row_ids, bits = [], [], [], []
+        rows = pq.ParquetFile(snapshot).metadata.num_rows
+        for column in self.columns:
+            encoded = (
+                pc.cast(
+                    pq.read_table(snapshot, columns=[column]).column(0), pa.string()
+                )
+                .combine_chunks()
+                .dictionary_encode()
+            )
+            if len(encoded.dictionary) > self.config.max_values:
+                logger.warning(
+                    "Bitmap index skips %s: %d values > max_values",
+                    column,
+                    len(encoded.dictionary),
+                )
+                continue
+            # A stable sort groups the row ids of each value, still ascending
+            order = pc.array_sort_indices(encoded.indices, null_placement="at_end")
+            counts = dict.fromkeys(range(len(encoded.dictionary)), 0)
+            counts.update(
+                (entry["values"], entry["counts"])
+                for entry in pc.value_counts(encoded.indices).to_pylist()
+                if entry["values"] is not None
+            )
+            offset = 0
+            for code, value in enumerate(encoded.dictionary.to_pylist()):
+                columns.append(column)
+                values.append(value)
+                if counts[code] * SPARSE_RATIO < rows:
+                    row_ids.append(order.slice(offset, counts[code]).cast(pa.uint32()))
+                    bits.append(None)
+                else:
+                    mask = pc.fill_null(
+                        pc.equal(
+                            encoded.indices, pa.scalar(code, encoded.indices.type)
+                        ),
+                        False,
+                    )
+                    row_ids.append(None)
+                    bits.append(mask.buffers()[1].to_pybytes()[: (rows + 7) // 8])
+                offset += counts[code]
+            os.utime(self._lock_file())
+        return pa.table(
+            {
+                "column": pa.array(columns, pa.string()),
+                "value": pa.array(values, pa.string()),
+                "row_ids": pa.array(row_ids, pa.list_(pa.uint32())),
+                "bits": pa.array(bits, pa.large_binary()),
+            }
+        ).replace_schema_metadata({"rows": str(rows)})
+
+    def _remove_old_generations(self, keep: str):
+        # The previous complete generation stays for previews still reading
+        # it. Incomplete ones are dropped once older than build_timeout: any
+        # build that old has lost its lock, so its owner is gone.
+        abandoned_before = int(keep) - int(self.config.build_timeout * 1e9)
+        complete = []
+        for path in self.config.directory.iterdir():
+            if not path.is_dir() or not path.name.isdigit() or path.name == keep:
+                continue
+            if (path / "bitmaps.parquet").exists() and (path / "days.parquet").exists():
+                if path.name < keep:
+                    complete.append(path)
+            elif int(path.name) < abandoned_before:
+                shutil.rmtree(path, ignore_errors=True)
+        for path in sorted(complete)[:-1]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def index(self) -> Optional[BitmapIndex]:
+        """
+        The current index, None while the first build is still running.
+
+        Reloads CURRENT when another process has built a newer generation,
+        and otherwise rebuilds in the background after refresh_interval. A
+        failed build is retried after retry_interval.
+        """
+        try:
+            current_at = self._current_file().stat().st_mtime
+        except FileNotFoundError:
+            current_at = None
+        if current_at is not None and current_at != self._current_at:
+            self._current_at = current_at
+            self._load()
+        if self.bitmap_index is None:
+            if not self._building_elsewhere():
+                self.rebuild.start()
+            return None
+        if time.time() - self.built_at > self.config.refresh_interval:
+            if not self._building_elsewhere():
+                self.rebuild.start()
+        return self.bitmap_index
+
+    def resolve(self, filters) -> Optional[Selection]:
+        index = self.index()
+        return index.resolve(filters) if index is not None else None
+
+    def count(self, filters) -> Optional[int]:
+        """Exact row count in the snapshot, None if the index cannot answer"""
+        selection = self.resolve(filters)
+        return selection.count() if selection is not None else None
+
+    def preview(
+        self, filters, limit: int = 200, columns: List[str] = None
+    ) -> Optional[pa.Table]:
+        """
+        The first limit matching rows of the snapshot, reading only the row
+        groups that hold them. None if the index cannot answer.
+        """
+        if self.index() is None:
+            return None
+        with self._lock:
+            index, snapshot = self.bitmap_index, self.snapshot_path
+        selection = index.resolve(filters)
+        if selection is None:
+            return None
+        ids = selection.row_ids(limit).to_pylist()
+        cols = ", ".join(columns) if columns else f"* EXCLUDE ({ROW_ID})"
+        return self.executor.fetch_arrow(
+            f"""SELECT {cols} FROM read_parquet('{snapshot.as_posix()}')
+                WHERE {ROW_ID} BETWEEN ? AND ? AND list_contains(?, {ROW_ID})
+                ORDER BY {ROW_ID}""",
+            [ids[0] if ids else 0, ids[-1] if ids else -1, ids],
+            kind=QUERY_PREVIEW,
+        )
+
+
+def get_snapshot_index() -> Optional[SnapshotIndex]:
+    return SnapshotIndex.instance("config.toml")
+
+
+if __name__ == "__main__":
+    snapshot_index = get_snapshot_index()
+    if snapshot_index is None:
+        print("Enable [bitmap] in config.toml to build the snapshot index")
+    else:
+        index = snapshot_index.build()
+        if index is None:
+            print("Another process is building the snapshot index")
+        else:
+            print(
+                f"Indexed {index.rows:,} rows over {len(index.bitmaps)} columns "
+                f"in {index.nbytes() / 1024**2:.1f} MB"
+            )
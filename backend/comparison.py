@@ -0,0 +1,227 @@
+import calendar
+import datetime
+import threading
+from typing import List, Optional, Tuple
+
+import pyarrow as pa
+
+from .admission import QUERY_AGGREGATE
+from .connection import DatabaseManager
+from .executor import QueryExecutor
+from .querybuilder import QueryBuilder
+from .timeseries import TimeSeriesConfig, TimeSeriesStore, get_timeseries_store
+
+Period = Tuple[datetime.date, datetime.date]
+
+_ROLLUP_OPERATORS = {"", "=", "IN"}
+
+
+def _shift_months(day: datetime.date, months: int) -> datetime.date:
+    month_index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    return day.replace(
+        year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1])
+    )
+
+
+def _is_month_end(day: datetime.date) -> bool:
+    return day.day == calendar.monthrange(day.year, day.month)[1]
+
+
+def _whole_months(period: Period) -> bool:
+    start, end = period
+    return start.day == 1 and _is_month_end(end)
+
+
+def previous_period(current: Period, mode: str = "prior") -> Period:
+    """
+    The period to compare current against.
+
+    Args:
+        current: (first day, last day), both inclusive
+        mode: "prior" for the period of the same length just before, or
+            "year" for the same dates one year earlier
+
+    Example:
+        previous_period((date(2024, 3, 1), date(2024, 3, 31)))
+        # (date(2024, 2, 1), date(2024, 2, 29))
+    """
+    start, end = current
+    if mode == "year":
+        months = 12
+    elif mode == "prior":
+        if not _whole_months(current):
+            length = end - start + datetime.timedelta(days=1)
+            return start - length, start - datetime.timedelta(days=1)
+        months = (end.year - start.year) * 12 + end.month - start.month + 1
+    else:
+        raise ValueError("mode must be 'prior' or 'year'")
+
+    previous_start = _shift_months(start, -months)
+    previous_end = _shift_months(end, -months)
+    if _is_month_end(end):
+        previous_end = previous_end.replace(
+            day=calendar.monthrange(previous_end.year, previous_end.month)[1]
+        )
+    return previous_start, previous_end
+
+
+class PeriodComparison:
+    """
+    Current vs previous period totals per dimension in a single scan.
+
+    Both periods are read in one pass over their combined date range and
+    split with conditional aggregation. When the dimensions and filters are
+    all held by the time-series rollups and both periods end before the
+    rollup watermark, the rollups are read instead of the source table.
+    """
+
+    _instance: Optional["PeriodComparison"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        table_name: str,
+        date_column: str = "DATEBAYAR",
+        value_column: str = "NOMINAL",
+        executor: QueryExecutor = None,
+        timeseries: TimeSeriesStore = None,
+    ):
+        self.table_name = table_name
+        self.date_column = date_column
+        self.value_column = value_column
+        self.executor = executor or QueryExecutor()
+        self.timeseries = timeseries
+
+    @classmethod
+    def instance(cls, config_file: str = "config.toml") -> "PeriodComparison":
+        with cls._instance_lock:
+            if cls._instance is None:
+                ts_config = TimeSeriesConfig(DatabaseManager(config_file).config)
+                cls._instance = cls(
+                    ts_config.source_table,
+                    ts_config.date_column,
+                    ts_config.value_column,
+                    timeseries=get_timeseries_store(),
+                )
+            return cls._instance
+
+    def _rollup_grain(self, filters, dimensions, periods) -> Optional[str]:
+        """The rollup grain able to answer the comparison, if any"""
+        if self.timeseries is None:
+            return None
+        columns = [f["column"] for f in filters]
+        if not self.timeseries.covers([*dimensions, *columns]):
+            return None
+        if any(
+            f["type"] != "string" or str(f["operator"]).upper() not in _ROLLUP_OPERATORS
+            for f in filters
+        ):
+            return None
+        watermark = self.timeseries.watermark()
+        # The watermark day itself may be partial, see TimeSeriesStore.refresh
+        if watermark is None or max(end for _, end in periods) >= watermark:
+            return None
+        return "month" if all(_whole_months(p) for p in periods) else "day"
+
+    def compare(
+        self,
+        filters,
+        dimensions: List[str],
+        current: Period,
+        previous: Optional[Period] = None,
+        mode: str = "prior",
+        use_rollups: bool = True,
+    ) -> pa.Table:
+        """
+        Compare the value column between two periods, per dimension.
+
+        Args:
+            filters: A QueryBuilder or its filters list; conditions on the
+                date column are ignored, the periods decide the dates
+            dimensions: Columns to group by, may be empty for a grand total
+            current: (first day, last day) of the current period, inclusive
+            previous: Period to compare against, derived from mode if None
+            mode: "prior" or "year", see previous_period()
+            use_rollups: Allow answering from the time-series rollups
+
+        Returns:
+            pa.Table: The dimensions, CURRENT, PREVIOUS, DELTA and GROWTH_PCT,
+                with schema metadata "source" set to "rollup" or "table"
+        """
+        if isinstance(filters, QueryBuilder):
+            filters = filters.filters
+        filters = [f for f in filters or [] if f["column"] != self.date_column]
+        previous = previous or previous_period(current, mode)
+        periods = (current, previous)
+
+        grain = (
+            self._rollup_grain(filters, dimensions, periods) if use_rollups else None
+        )
+        if grain is not None:
+            executor = self.timeseries.executor
+            source = self.timeseries._table(grain)
+            date_expr = "period"
+        else:
+            executor = self.executor
+            source = self.table_name
+            date_expr = f'"{self.date_column}"'
+
+        builder = QueryBuilder(source)
+        for f in filters:
+            builder.add_condition(f["column"], f["type"], f["operator"], f["value"])
+
+        query, params = self._build_query(
+            source, date_expr, dimensions, builder, current, previous
+        )
+        table = executor.fetch_arrow(query, params, kind=QUERY_AGGREGATE)
+        return table.replace_schema_metadata(
+            {"source": "rollup" if grain is not None else "table"}
+        )
+
+    def _build_query(self, source, date_expr, dimensions, builder, current, previous):
+        one_day = datetime.timedelta(days=1)
+        # Half-open [start, end + 1 day) ranges so timestamps on the last day count
+        current_range = [current[0], current[1] + one_day]
+        previous_range = [previous[0], previous[1] + one_day]
+        in_range = f"{date_expr} >= ? AND {date_expr} < ?"
+        value = f'"{self.value_column}"'
+
+        dims = "".join(f'"{dim}", ' for dim in dimensions)
+        conditions = [
+            *builder.conditions,
+            # The hull is a single range the Postgres scan can push down
+            in_range,
+            f"(({in_range}) OR ({in_range}))",
+        ]
+        params = [
+            *current_range,
+            *previous_range,
+            *builder.params,
+            min(current_range[0], previous_range[0]),
+            max(current_range[1], previous_range[1]),
+            *current_range,
+            *previous_range,
+        ]
+
+        query = f"""SELECT {dims}"CURRENT", "PREVIOUS",
+                "CURRENT" - "PREVIOUS" AS "DELTA",
+                CASE WHEN "PREVIOUS" = 0 THEN NULL
+                    ELSE CAST(("CURRENT" - "PREVIOUS") * 100 AS DOUBLE)
+                        / ABS(CAST("PREVIOUS" AS DOUBLE))
+                END AS "GROWTH_PCT"
+            FROM (
+                SELECT {dims}
+                    COALESCE(SUM({value}) FILTER (WHERE {in_range}), 0) AS "CURRENT",
+                    COALESCE(SUM({value}) FILTER (WHERE {in_range}), 0) AS "PREVIOUS"
+                FROM {source}
+                WHERE {" AND ".join(conditions)}
+                {"GROUP BY ALL" if dimensions else ""}
+            )
+            ORDER BY "CURRENT" DESC"""
+        return query, params
+
+
+def get_period_comparison() -> PeriodComparison:
+    return PeriodComparison.instance("config.toml")
@@ -1,3 +1,4 @@
+import os
 from typing import Optional
 
 import duckdb
@@ -14,6 +15,17 @@ class DatabaseConfig:
         self.db_flavour = config["db"]["db_flavour"]
 
 
+class ResourceConfig:
+    def __init__(self, config):
+        resources = config.get("resources", {})
+        self.memory_limit = resources.get("memory_limit")
+        self.temp_directory = resources.get("temp_directory")
+        self.threads = resources.get("threads")
+        self.max_heavy_queries = int(resources.get("max_heavy_queries", 2))
+        self.max_queued_queries = resources.get("max_queued_queries")
+        self.queue_timeout = resources.get("queue_timeout")
+
+
 class DBConnectionString:
     @staticmethod
     def postgres_connection_string(host, port, user, database, password):
@@ -41,6 +53,7 @@ class DatabaseManager:
 
         self.config = self.load_config(config_file)
         self.db_config = DatabaseConfig(self.config)
+        self.resource_config = ResourceConfig(self.config)
         self._initialized = True
 
     @property
@@ -55,12 +68,17 @@ class DatabaseManager:
             return toml.load(f)
 
     def create_connection(self):
-        return InitiateConnection(self.db_config).setup_connection()
+        return InitiateConnection(
+            self.db_config, self.resource_config
+        ).setup_connection()
 
 
 class InitiateConnection:
-    def __init__(self, db_config: DatabaseConfig):
+    def __init__(
+        self, db_config: DatabaseConfig, resource_config: ResourceConfig = None
+    ):
         self.db_config = db_config
+        self.resource_config = resource_config
         self.connection_string = self._create_connection_string()
         self.connection_attach = self._create_connection_attach()
 
@@ -83,8 +101,21 @@ class InitiateConnection:
             user={self.db_config.user} dbname={self.db_config.database} 
             password={self.db_config.password} sslmode=disable"""
 
+    def _apply_resource_settings(self, con):
+        """Bound DuckDB's memory and threads, and let large operators spill"""
+        if self.resource_config is None:
+            return
+        if self.resource_config.memory_limit:
+            con.execute(f"SET memory_limit = '{self.resource_config.memory_limit}'")
+        if self.resource_config.temp_directory:
+            os.makedirs(self.resource_config.temp_directory, exist_ok=True)
+            con.execute(f"SET temp_directory = '{self.resource_config.temp_directory}'")
+        if self.resource_config.threads:
+            con.execute(f"SET threads = {int(self.resource_config.threads)}")
+
     def setup_connection(self):
         con = duckdb.connect()
+        self._apply_resource_settings(con)
         con.install_extension(f"{self.db_config.db_flavour}")
         con.load_extension(f"{self.db_config.db_flavour}")
         con.install_extension("excel")
@@ -0,0 +1,184 @@
+import json
+from typing import List, Optional
+
+import duckdb
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+from .admission import AdmissionController, get_admission_controller
+from .connection import get_db_connection
+from .querylog import SlowQueryLog, get_query_log
+from .resultcache import ResultCache, get_result_cache
+
+
+class QueryExecutor:
+    """
+    Run QueryBuilder queries and hand the results back as Arrow.
+
+    Results stay in Arrow from DuckDB to the caller, so the grid, the cache
+    and the exporters never pay for a pandas conversion. Use ``fetch_df``
+    only when a caller really needs a DataFrame.
+
+    Every query goes through the admission controller, so full-result
+    queries queue for a heavy slot while previews and counts run at once.
+    When the shared result cache is enabled, fetch_arrow and fetch_scalar
+    serve repeated queries from it, and queries slower than the slow-query
+    log threshold are recorded with their DuckDB profile.
+    """
+
+    DEFAULT_BATCH_SIZE = 100_000
+
+    def __init__(
+        self,
+        conn=None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        admission: AdmissionController = None,
+        cache: ResultCache = None,
+        use_cache: bool = True,
+        query_log: SlowQueryLog = None,
+        use_query_log: bool = True,
+    ):
+        self._conn = conn
+        self.batch_size = batch_size
+        self._admission = admission
+        self._cache = cache
+        self.use_cache = use_cache
+        self._query_log = query_log
+        self.use_query_log = use_query_log
+
+    @property
+    def connection(self):
+        if self._conn is None:
+            self._conn = get_db_connection()
+        return self._conn
+
+    @property
+    def admission(self) -> AdmissionController:
+        if self._admission is None:
+            self._admission = get_admission_controller()
+        return self._admission
+
+    @property
+    def cache(self) -> Optional[ResultCache]:
+        if self._cache is None and self.use_cache:
+            self._cache = get_result_cache()
+        return self._cache if self.use_cache else None
+
+    @property
+    def query_log(self) -> Optional[SlowQueryLog]:
+        if self._query_log is None and self.use_query_log:
+            self._query_log = get_query_log()
+        return self._query_log if self.use_query_log else None
+
+    def cursor(self):
+        """Return a cursor on the shared connection, safe to use from one thread"""
+        return self.connection.cursor()
+
+    def fetch_batches(
+        self,
+        query: str,
+        params: Optional[List] = None,
+        batch_size: int = None,
+        kind: str = None,
+    ) -> pa.RecordBatchReader:
+        """
+        Stream the result of a query as Arrow record batches.
+
+        The admission slot is held until the reader is exhausted or closed.
+
+        Args:
+            query: SQL text, usually from QueryBuilder.build_select()
+            params: Positional parameters for the query
+            batch_size: Rows per record batch
+            kind: Query kind for admission control, guessed from query if None
+
+        Returns:
+            pa.RecordBatchReader: Reader over the result set
+        """
+        kind = kind or self.admission.classify(query)
+        query_log = self.query_log
+        held = self.admission.acquire(kind)
+        log_handle = None
+        try:
+            cur = self.cursor()
+            log_handle = query_log.start(cur) if query_log else None
+            cur.execute(query, params or [])
+            reader = cur.fetch_record_batch(batch_size or self.batch_size)
+        except BaseException as e:
+            if held:
+                self.admission.release()
+            if log_handle is not None:
+                query_log.finish(log_handle, query, params, kind, error=e)
+            raise
+        if not held and query_log is None:
+            return reader
+
+        def finish_when_done():
+            error = None
+            try:
+                yield from reader
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                if held:
+                    self.admission.release()
+                if query_log:
+                    query_log.finish(log_handle, query, params, kind, error=error)
+
+        return pa.RecordBatchReader.from_batches(reader.schema, finish_when_done())
+
+    def fetch_arrow(
+        self, query: str, params: Optional[List] = None, kind: str = None
+    ) -> pa.Table:
+        """Run a query and return the full result as an Arrow table"""
+        if self.cache is None:
+            return self.fetch_batches(query, params, kind=kind).read_all()
+        return self.cache.get_or_compute(
+            query,
+            params,
+            lambda: self.fetch_batches(query, params, kind=kind).read_all(),
+        )
+
+    def fetch_df(self, query: str, params: Optional[List] = None, kind: str = None):
+        """Run a query and return a pandas DataFrame (explicit opt-in)"""
+        return self.fetch_arrow(query, params, kind).to_pandas()
+
+    def fetch_scalar(self, query: str, params: Optional[List] = None, kind: str = None):
+        """Run a query returning a single value, e.g. QueryBuilder.build_count()"""
+        table = self.fetch_arrow(query, params, kind)
+        return table.column(0)[0].as_py() if table.num_rows else None
+
+    def estimate_rows(self, query: str, params: Optional[List] = None) -> Optional[int]:
+        """
+        DuckDB's planner estimate of the rows query returns, without running
+        it. Filters on a Postgres scan get default selectivities, so treat
+        it as an order of magnitude. None if the plan carries no estimate.
+        """
+        try:
+            plan = (
+                self.cursor()
+                .execute(f"EXPLAIN (FORMAT JSON) {query}", params or [])
+                .fetchall()
+            )
+            node = json.loads(plan[0][1])[0]
+        except (duckdb.Error, ValueError, IndexError):
+            return None
+        # Operators that keep every row, like PROJECTION, may carry no estimate
+        while node is not None:
+            estimate = node.get("extra_info", {}).get("Estimated Cardinality")
+            if estimate is not None:
+                try:
+                    return int(str(estimate).lstrip("~"))
+                except ValueError:
+                    return None
+            children = node.get("children") or [None]
+            node = children[0]
+        return None
+
+
+def table_to_csv(table: pa.Table) -> bytes:
+    """Serialize an Arrow table to CSV bytes without going through pandas"""
+    sink = pa.BufferOutputStream()
+    pacsv.write_csv(table, sink)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,256 @@
+import os
+import re
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+EXCEL_MAX_ROWS = 1_048_576
+DEFAULT_EXCEL_ROWS_PER_FILE = 500_000
+DEFAULT_BATCH_SIZE = 100_000
+PARQUET_ROW_GROUP_SIZE = 122_880
+
+# Result sizes (rows) at which the suggested download format changes
+SMALL_RESULT_ROWS = 100_000
+LARGE_RESULT_ROWS = 2_000_000
+
+EXPORT_FORMATS = {
+    "csv": {
+        "extension": "csv",
+        "mime": "text/csv",
+        "options": "HEADER TRUE, DELIMITER ','",
+    },
+    "csv_gz": {
+        "extension": "csv.gz",
+        "mime": "application/gzip",
+        "options": "HEADER TRUE, DELIMITER ',', COMPRESSION gzip",
+    },
+    "csv_zst": {
+        "extension": "csv.zst",
+        "mime": "application/zstd",
+        "options": "HEADER TRUE, DELIMITER ',', COMPRESSION zstd",
+    },
+    "parquet": {
+        "extension": "parquet",
+        "mime": "application/vnd.apache.parquet",
+        "options": (
+            f"FORMAT PARQUET, COMPRESSION zstd, ROW_GROUP_SIZE {PARQUET_ROW_GROUP_SIZE}"
+        ),
+    },
+    "xlsx": {
+        "extension": "xlsx",
+        "mime": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "options": "FORMAT EXCEL",
+    },
+    # Large results: several xlsx files of bounded size bundled into a zip
+    "xlsx_zip": {
+        "extension": "zip",
+        "mime": "application/zip",
+        "chunked": True,
+    },
+}
+
+
+def get_export_format(file_format: str) -> dict:
+    try:
+        return EXPORT_FORMATS[file_format]
+    except KeyError:
+        raise ValueError(
+            f"Unsupported export format '{file_format}', "
+            f"expected one of {sorted(EXPORT_FORMATS)}"
+        )
+
+
+def suggest_export_format(
+    estimated_rows: Optional[int],
+    small_result_rows: int = SMALL_RESULT_ROWS,
+    large_result_rows: int = LARGE_RESULT_ROWS,
+) -> str:
+    """
+    Pick a default download format for a result of the given size.
+
+    Small results stay plain CSV, mid-sized ones are gzip-compressed and
+    multi-million-row results default to Parquet. Results of unknown size
+    get compressed CSV, which stays readable while capping the download.
+
+    Args:
+        estimated_rows: Row count of the result, None if unknown
+        small_result_rows: Largest result still served as plain CSV
+        large_result_rows: Largest result served as compressed CSV
+
+    Returns:
+        str: A key of EXPORT_FORMATS
+    """
+    if estimated_rows is None:
+        return "csv_gz"
+    if estimated_rows <= small_result_rows:
+        return "csv"
+    if estimated_rows <= large_result_rows:
+        return "csv_gz"
+    return "parquet"
+
+
+def export_query(
+    conn,
+    query: str,
+    params: Optional[List],
+    path,
+    file_format: str = "csv",
+    options: Optional[dict] = None,
+) -> Path:
+    """
+    Write the result of a query to a file using DuckDB's native COPY command.
+
+    The file is written under a temporary name and renamed once complete, so
+    readers never see a half-written export.
+
+    Args:
+        conn: DuckDB connection or cursor to run the COPY on
+        query: SQL text, usually from QueryBuilder.build_select()
+        params: Positional parameters for the query
+        path: Destination file path
+        file_format: One of EXPORT_FORMATS
+        options: Extra keyword arguments for chunked formats, e.g.
+            {"rows_per_file": 200000, "split_by": "ADMIN"}
+
+    Returns:
+        Path: The written file
+    """
+    export_format = get_export_format(file_format)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f".{path.name}.part")
+
+    try:
+        if export_format.get("chunked"):
+            export_excel_chunked(conn, query, params, temp_path, **(options or {}))
+        else:
+            copy_query = f"""COPY ({query}) TO '{temp_path.as_posix()}'
+                           WITH ({export_format["options"]})"""
+            conn.execute(copy_query, params or [])
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    return path
+
+
+def export_excel_chunked(
+    conn,
+    query: str,
+    params: Optional[List],
+    path,
+    rows_per_file: int = DEFAULT_EXCEL_ROWS_PER_FILE,
+    split_by: Optional[str] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Path:
+    """
+    Export a result of any size as several xlsx files bundled in a zip.
+
+    Rows are streamed from DuckDB as Arrow batches and cut into files of at
+    most rows_per_file rows, so each file stays under Excel's sheet limit and
+    only one file's worth of rows is held in memory at a time.
+
+    Args:
+        conn: DuckDB connection or cursor
+        query: SQL text, usually from QueryBuilder.build_select()
+        params: Positional parameters for the query
+        path: Destination zip file
+        rows_per_file: Maximum data rows per xlsx file
+        split_by: Optional column; each of its values gets its own file(s)
+        batch_size: Rows per Arrow batch read from DuckDB
+
+    Returns:
+        Path: The written zip file
+    """
+    if not 0 < rows_per_file < EXCEL_MAX_ROWS:
+        raise ValueError(f"rows_per_file must be between 1 and {EXCEL_MAX_ROWS - 1}")
+
+    if split_by:
+        query = f'SELECT * FROM ({query}) ORDER BY "{split_by}"'
+
+    path = Path(path)
+    with (
+        tempfile.TemporaryDirectory(dir=path.parent) as temp_dir,
+        zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as bundle,
+    ):
+        writer = _ExcelPartWriter(conn.cursor(), Path(temp_dir), bundle, rows_per_file)
+        reader = conn.execute(query, params or []).fetch_record_batch(batch_size)
+        for batch in reader:
+            if not split_by:
+                writer.write(batch, "part")
+                continue
+            # Rows arrive sorted on split_by, so each value is one contiguous run
+            runs = pc.run_end_encode(batch.column(split_by))
+            start = 0
+            for end, value in zip(runs.run_ends.to_pylist(), runs.values.to_pylist()):
+                writer.write(batch.slice(start, end - start), _part_name(value))
+                start = end
+        writer.close(reader.schema)
+    return path
+
+
+def _part_name(value) -> str:
+    if value is None:
+        return "NULL"
+    return re.sub(r"[^\w.-]+", "_", str(value)).strip("_") or "part"
+
+
+class _ExcelPartWriter:
+    """Buffers Arrow batches and writes them out as bounded xlsx parts"""
+
+    def __init__(self, conn, temp_dir: Path, bundle: zipfile.ZipFile, rows_per_file):
+        self.conn = conn
+        self.temp_dir = temp_dir
+        self.bundle = bundle
+        self.rows_per_file = rows_per_file
+        self.group = None
+        self.pending = []
+        self.pending_rows = 0
+        self.part_counts = {}
+
+    def write(self, batch: pa.RecordBatch, group: str):
+        if group != self.group:
+            self.flush()
+            self.group = group
+
+        offset = 0
+        while offset < batch.num_rows:
+            take = min(self.rows_per_file - self.pending_rows, batch.num_rows - offset)
+            self.pending.append(batch.slice(offset, take))
+            self.pending_rows += take
+            offset += take
+            if self.pending_rows >= self.rows_per_file:
+                self.flush()
+
+    def flush(self, schema: pa.Schema = None):
+        if not self.pending and schema is None:
+            return
+
+        table = pa.Table.from_batches(self.pending, schema=schema)
+        index = self.part_counts.get(self.group, 0) + 1
+        self.part_counts[self.group] = index
+        name = f"{self.group}_{index:03d}.xlsx"
+        part = self.temp_dir / name
+
+        self.conn.register("excel_part", table)
+        try:
+            self.conn.execute(f"""COPY excel_part TO '{part.as_posix()}'
+                    WITH ({EXPORT_FORMATS["xlsx"]["options"]})""")
+        finally:
+            self.conn.unregister("excel_part")
+
+        self.bundle.write(part, arcname=name)
+        part.unlink()
+        self.pending = []
+        self.pending_rows = 0
+
+    def close(self, schema: pa.Schema):
+        self.flush()
+        # An empty result still gets one file with just the header
+        if not self.part_counts:
+            self.group = "part"
+            self.flush(schema)
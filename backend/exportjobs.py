@@ -0,0 +1,343 @@
+import contextvars
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import List, Optional
+
+from .admission import QUERY_EXPORT
+from .connection import DatabaseManager
+from .executor import QueryExecutor
+from .exporters import (
+    DEFAULT_EXCEL_ROWS_PER_FILE,
+    LARGE_RESULT_ROWS,
+    SMALL_RESULT_ROWS,
+    export_query,
+    get_export_format,
+    suggest_export_format,
+)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+IN_FLIGHT = (JOB_QUEUED, JOB_RUNNING)
+FINISHED = (JOB_DONE, JOB_FAILED)
+
+logger = logging.getLogger(__name__)
+
+
+class ExportConfig:
+    def __init__(self, config):
+        export = config.get("export", {})
+        self.directory = Path(export.get("directory", "exports"))
+        self.job_store = Path(export.get("job_store", self.directory / "jobs.sqlite"))
+        self.workers = int(export.get("workers", 2))
+        self.small_result_rows = int(export.get("small_result_rows", SMALL_RESULT_ROWS))
+        self.large_result_rows = int(export.get("large_result_rows", LARGE_RESULT_ROWS))
+        self.excel_rows_per_file = int(
+            export.get("excel_rows_per_file", DEFAULT_EXCEL_ROWS_PER_FILE)
+        )
+        self.retention_hours = float(export.get("retention_hours", 72))
+        self.max_size_mb = int(export.get("max_size_mb", 20480))
+
+
+class ExportJobStore:
+    """
+    Job state for background exports, kept in a local SQLite file so it
+    outlives Streamlit reruns and process restarts.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    job_key TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    file_format TEXT NOT NULL,
+                    options TEXT NOT NULL DEFAULT '{}',
+                    status TEXT NOT NULL,
+                    path TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )""")
+            con.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (job_key, status)")
+            columns = [row["name"] for row in con.execute("PRAGMA table_info(jobs)")]
+            if "options" not in columns:
+                con.execute(
+                    "ALTER TABLE jobs ADD COLUMN options TEXT NOT NULL DEFAULT '{}'"
+                )
+
+    @contextmanager
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        con.row_factory = sqlite3.Row
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["options"] = json.loads(job["options"])
+        return job
+
+    def create_or_get(
+        self, job_key, query, params, file_format, options=None
+    ) -> tuple[dict, bool]:
+        """
+        Return the in-flight job for job_key, or create a queued one.
+
+        Returns:
+            tuple[dict, bool]: The job and whether it was newly created
+        """
+        with self._lock, self._connect() as con:
+            row = con.execute(
+                f"""SELECT * FROM jobs WHERE job_key = ?
+                    AND status IN ({",".join("?" for _ in IN_FLIGHT)})
+                    ORDER BY created_at LIMIT 1""",
+                [job_key, *IN_FLIGHT],
+            ).fetchone()
+            if row is not None:
+                return self._to_dict(row), False
+
+            now = time.time()
+            job_id = uuid.uuid4().hex
+            con.execute(
+                """INSERT INTO jobs (id, job_key, query, params, file_format,
+                    options, status, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [
+                    job_id,
+                    job_key,
+                    query,
+                    json.dumps(params, default=str),
+                    file_format,
+                    json.dumps(options or {}),
+                    JOB_QUEUED,
+                    now,
+                    now,
+                ],
+            )
+            return self.get(job_id, con), True
+
+    def get(self, job_id, con=None) -> Optional[dict]:
+        if con is None:
+            with self._connect() as con:
+                return self.get(job_id, con)
+        row = con.execute("SELECT * FROM jobs WHERE id = ?", [job_id]).fetchone()
+        return self._to_dict(row)
+
+    def update(self, job_id, status, path=None, error=None):
+        with self._lock, self._connect() as con:
+            con.execute(
+                """UPDATE jobs SET status = ?, path = COALESCE(?, path),
+                    error = ?, updated_at = ? WHERE id = ?""",
+                [status, path, error, time.time(), job_id],
+            )
+
+    def list_jobs(self, limit: int = 50) -> List[dict]:
+        with self._connect() as con:
+            rows = con.execute(
+                "SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", [limit]
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def finished(self) -> List[dict]:
+        """Done and failed jobs, most recently finished first"""
+        with self._connect() as con:
+            rows = con.execute(
+                f"""SELECT * FROM jobs
+                    WHERE status IN ({",".join("?" for _ in FINISHED)})
+                    ORDER BY updated_at DESC""",
+                list(FINISHED),
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def delete(self, job_ids: List[str]):
+        with self._lock, self._connect() as con:
+            con.executemany("DELETE FROM jobs WHERE id = ?", [[i] for i in job_ids])
+
+    def in_flight(self) -> List[dict]:
+        with self._connect() as con:
+            rows = con.execute(
+                f"""SELECT * FROM jobs
+                    WHERE status IN ({",".join("?" for _ in IN_FLIGHT)})
+                    ORDER BY created_at""",
+                list(IN_FLIGHT),
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+
+class ExportJobManager:
+    """
+    Runs exports of QueryBuilder queries on a background worker pool.
+
+    Identical requests that are still queued or running are coalesced into
+    one job, and finished files are written to the export directory. Files
+    and their jobs are removed after retention_hours, or sooner, oldest
+    first, once the directory holds more than max_size_mb.
+    """
+
+    _instance: Optional["ExportJobManager"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, export_config: ExportConfig, executor: QueryExecutor = None):
+        self.config = export_config
+        self.config.directory.mkdir(parents=True, exist_ok=True)
+        self.store = ExportJobStore(self.config.job_store)
+        self.executor = executor or QueryExecutor()
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.config.workers, thread_name_prefix="export"
+        )
+        self._resume_interrupted()
+        self.sweep()
+
+    @classmethod
+    def instance(cls, config_file: str = "config.toml") -> "ExportJobManager":
+        with cls._instance_lock:
+            if cls._instance is None:
+                config = DatabaseManager(config_file).config
+                cls._instance = cls(ExportConfig(config))
+            return cls._instance
+
+    @staticmethod
+    def job_key(
+        query: str, params: Optional[List], file_format: str, options=None
+    ) -> str:
+        payload = json.dumps(
+            [query, params or [], file_format, options or {}],
+            default=str,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def submit(
+        self,
+        query: str,
+        params: Optional[List],
+        file_format: str = "csv",
+        options: Optional[dict] = None,
+    ):
+        """
+        Queue an export of query, or join the identical one already in flight.
+
+        Args:
+            query: SQL text, usually from QueryBuilder.build_select()
+            params: Positional parameters for the query
+            file_format: One of EXPORT_FORMATS
+            options: Extra writer options for chunked formats
+
+        Returns:
+            dict: The job record
+        """
+        if get_export_format(file_format).get("chunked"):
+            options = {
+                "rows_per_file": self.config.excel_rows_per_file,
+                **(options or {}),
+            }
+        params = list(params or [])
+        job, created = self.store.create_or_get(
+            self.job_key(query, params, file_format, options),
+            query,
+            params,
+            file_format,
+            options,
+        )
+        if created:
+            # Carry the submitting session over to the worker for the query log
+            self.pool.submit(contextvars.copy_context().run, self._run, job)
+        return job
+
+    def _resume_interrupted(self):
+        """Requeue jobs that were in flight when the previous process stopped"""
+        for job in self.store.in_flight():
+            self.store.update(job["id"], JOB_QUEUED)
+            self.pool.submit(self._run, job)
+
+    def sweep(self):
+        """Delete finished exports past retention, then the oldest over size"""
+        cutoff = time.time() - self.config.retention_hours * 3600
+        max_bytes = self.config.max_size_mb * 1024**2
+        total, expired = 0, []
+        for i, job in enumerate(self.store.finished()):
+            path = Path(job["path"]) if job["path"] else None
+            if path is not None and path.exists():
+                total += path.stat().st_size
+            # The newest export is kept even when it alone exceeds max_size_mb
+            if job["updated_at"] < cutoff or (i > 0 and total > max_bytes):
+                if path is not None:
+                    path.unlink(missing_ok=True)
+                expired.append(job["id"])
+        if expired:
+            self.store.delete(expired)
+
+    def suggest_format(self, estimated_rows: Optional[int]) -> str:
+        """Default download format for a result of estimated_rows rows"""
+        return suggest_export_format(
+            estimated_rows, self.config.small_result_rows, self.config.large_result_rows
+        )
+
+    def output_path(self, job) -> Path:
+        extension = get_export_format(job["file_format"])["extension"]
+        return self.config.directory / f"{job['id']}.{extension}"
+
+    def _run(self, job):
+        try:
+            query, params = job["query"], job["params"]
+            cached = self.executor.cache and self.executor.cache.lookup_path(
+                query, params
+            )
+            if cached:
+                # Copy from the cached Parquet file instead of the source
+                query, params = f"SELECT * FROM read_parquet('{cached.as_posix()}')", []
+            with self.executor.admission.admit(QUERY_EXPORT):
+                self.store.update(job["id"], JOB_RUNNING)
+                cur = self.executor.cursor()
+                query_log = self.executor.query_log
+                with (
+                    query_log.capture(cur, query, params, QUERY_EXPORT)
+                    if query_log
+                    else nullcontext()
+                ):
+                    path = export_query(
+                        cur,
+                        query,
+                        params,
+                        self.output_path(job),
+                        job["file_format"],
+                        job["options"],
+                    )
+        except Exception as e:
+            logger.exception("Export job %s failed", job["id"])
+            self.store.update(job["id"], JOB_FAILED, error=str(e))
+            return
+        self.store.update(job["id"], JOB_DONE, path=str(path))
+        self.sweep()
+
+    def get(self, job_id) -> Optional[dict]:
+        return self.store.get(job_id)
+
+    def list_jobs(self, limit: int = 50) -> List[dict]:
+        return self.store.list_jobs(limit)
+
+
+def get_export_manager() -> ExportJobManager:
+    return ExportJobManager.instance("config.toml")
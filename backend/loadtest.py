@@ -0,0 +1,548 @@
+import argparse
+import datetime
+import json
+import math
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import duckdb
+
+from .admission import AdmissionController, AdmissionRejected
+from .comparison import PeriodComparison
+from .connection import (
+    DatabaseConfig,
+    DatabaseManager,
+    InitiateConnection,
+    ResourceConfig,
+)
+from .executor import QueryExecutor
+from .exportjobs import JOB_DONE, JOB_FAILED, ExportConfig, ExportJobManager
+from .querybuilder import QueryBuilder
+from .querylog import set_session
+from .resultcache import ResultCache
+from .typeahead import TypeaheadConfig
+
+OPERATIONS = ("preview", "count", "aggregate", "export")
+DEFAULT_MIX = {"preview": 0.5, "count": 0.25, "aggregate": 0.2, "export": 0.05}
+
+
+class LoadTestConfig:
+    def __init__(self, config):
+        loadtest = config.get("loadtest", {})
+        db = config["db"]
+        self.target = loadtest.get("target", "duckdb")
+        self.database = loadtest.get("database", "data/loadtest.duckdb")
+        self.table_name = loadtest.get(
+            "table_name", f"db.{db['schema']}.{db['database']}"
+        )
+        self.rows = int(loadtest.get("rows", 1_000_000))
+        self.sessions = int(loadtest.get("sessions", 8))
+        self.duration = float(loadtest.get("duration", 60))
+        self.ramp_up = float(loadtest.get("ramp_up", 0))
+        self.think_time = float(loadtest.get("think_time", 1.0))
+        self.mix = {**DEFAULT_MIX, **loadtest.get("mix", {})}
+        self.export_formats = list(loadtest.get("export_formats", ["parquet"]))
+        self.export_timeout = float(loadtest.get("export_timeout", 600))
+        self.cache = bool(loadtest.get("cache", False))
+        self.output = Path(loadtest.get("output", "logs/loadtest"))
+        self.seed = int(loadtest.get("seed", 0))
+
+
+def _literal(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def synthetic_select(config, rows: int, seed: int = 0) -> str:
+    """
+    SELECT producing rows of synthetic data shaped like the source table.
+
+    String filter columns draw from their [filters] values, DATEBAYAR is
+    spread over the [filters] year range and the typeahead columns get a
+    high-cardinality id. The output only depends on rows and seed.
+    """
+    filters = config.get("filters", {})
+    filters_types = config.get("filters_types", {})
+    first_year, last_year = filters.get("DATEBAYAR", [2021, 2024])
+    start = datetime.datetime(first_year, 1, 1)
+    span = int((datetime.datetime(last_year + 1, 1, 1) - start).total_seconds())
+
+    def draw(column: str) -> str:
+        return f"hash(i + {seed}, {_literal(column)})"
+
+    columns = [
+        f"TIMESTAMP '{start:%Y-%m-%d}' + to_seconds(CAST({draw('DATEBAYAR')} % {span} AS BIGINT)) AS \"DATEBAYAR\"",
+        f"CAST({draw('NOMINAL')} % 100000000 / 100.0 AS DECIMAL(18, 2)) AS \"NOMINAL\"",
+    ]
+    for column, column_type in filters_types.items():
+        values = filters.get(column)
+        if column_type != "string" or not values:
+            continue
+        options = ", ".join(_literal(value) for value in values)
+        columns.append(
+            f'[{options}][1 + CAST({draw(column)} % {len(values)} AS BIGINT)] AS "{column}"'
+        )
+    for column in TypeaheadConfig(config).columns:
+        columns.append(
+            f"lpad(CAST({draw(column)} % {max(rows // 20, 1)} AS VARCHAR), 15, '0') AS \"{column}\""
+        )
+
+    return f"""SELECT *, year("DATEBAYAR") AS "TAHUNBAYAR",
+            month("DATEBAYAR") AS "BULANBAYAR"
+        FROM (SELECT {", ".join(columns)} FROM range({rows}) t(i))"""
+
+
+def _table_rows(con, table_name: str) -> Optional[int]:
+    try:
+        return con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    except duckdb.CatalogException:
+        return None
+
+
+def open_target(config, lt_config: LoadTestConfig, populate: bool = False):
+    """
+    Connect to the load-test database and make sure the table is there.
+
+    "duckdb" attaches a local DuckDB file as db and (re)builds the synthetic
+    table whenever its row count differs from rows. "postgres" attaches the
+    [db] server like the app does; it is only written to with populate=True,
+    and then only if the table does not exist yet.
+    """
+    resource_config = ResourceConfig(config)
+    if lt_config.target == "duckdb":
+        con = duckdb.connect()
+        InitiateConnection(
+            DatabaseConfig(config), resource_config
+        )._apply_resource_settings(con)
+        Path(lt_config.database).parent.mkdir(parents=True, exist_ok=True)
+        con.execute(f"ATTACH {_literal(lt_config.database)} AS db")
+        schema = lt_config.table_name.rsplit(".", 1)[0]
+        con.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+        if _table_rows(con, lt_config.table_name) != lt_config.rows:
+            print(f"Generating {lt_config.rows:,} synthetic rows...")
+            con.execute(
+                f"CREATE OR REPLACE TABLE {lt_config.table_name} AS "
+                + synthetic_select(config, lt_config.rows, lt_config.seed)
+            )
+        return con
+
+    if lt_config.target == "postgres":
+        con = InitiateConnection(
+            DatabaseConfig(config), resource_config
+        ).setup_connection()
+        if _table_rows(con, lt_config.table_name) is None:
+            if not populate:
+                raise ValueError(
+                    f"{lt_config.table_name} does not exist, run with --populate"
+                )
+            print(f"Generating {lt_config.rows:,} synthetic rows in Postgres...")
+            con.execute(
+                f"CREATE TABLE {lt_config.table_name} AS "
+                + synthetic_select(config, lt_config.rows, lt_config.seed)
+            )
+        return con
+
+    raise ValueError("target must be 'duckdb' or 'postgres'")
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(q / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class MemorySampler:
+    """Tracks peak process RSS and DuckDB buffer/spill usage in the background"""
+
+    def __init__(self, con, interval: float = 0.25):
+        self.con = con
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_duckdb_memory = 0
+        self.peak_duckdb_temp = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="loadtest-memory", daemon=True
+        )
+
+    @staticmethod
+    def _rss() -> int:
+        try:
+            # resource is Unix only, RSS is reported as 0 elsewhere
+            import resource
+        except ImportError:
+            return 0
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            # ru_maxrss is the lifetime peak, in bytes on macOS and KB elsewhere
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self._rss())
+        memory, temp = (
+            self.con.cursor().execute("""SELECT COALESCE(SUM(memory_usage_bytes), 0),
+                    COALESCE(SUM(temporary_storage_bytes), 0)
+                FROM duckdb_memory()""").fetchone()
+        )
+        self.peak_duckdb_memory = max(self.peak_duckdb_memory, memory)
+        self.peak_duckdb_temp = max(self.peak_duckdb_temp, temp)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+class LoadTest:
+    """
+    Simulates concurrent analyst sessions against the real backend API.
+
+    Each session thread loops until the deadline, picking an operation from
+    the configured mix and pausing for an exponentially distributed think
+    time in between:
+
+        preview    QueryBuilder.build_select() with the default LIMIT
+        count      QueryBuilder.build_count()
+        aggregate  PeriodComparison.compare() on a random date range
+        export     ExportJobManager.submit(), timed until the file is written
+
+    All sessions share one QueryExecutor, admission controller and export
+    manager, like the Streamlit app's sessions do.
+    """
+
+    def __init__(self, config, lt_config: LoadTestConfig, con):
+        self.config = config
+        self.lt_config = lt_config
+        self.filters = config.get("filters", {})
+        self.filters_types = config.get("filters_types", {})
+        self.string_columns = [
+            column
+            for column, column_type in self.filters_types.items()
+            if column_type == "string" and self.filters.get(column)
+        ]
+
+        self.run_dir = lt_config.output / time.strftime("%Y%m%d_%H%M%S")
+        resources = ResourceConfig(config)
+        self.con = con
+        self.executor = QueryExecutor(
+            con,
+            admission=AdmissionController(
+                resources.max_heavy_queries,
+                resources.max_queued_queries,
+                resources.queue_timeout,
+            ),
+            cache=(
+                ResultCache(self.run_dir / "cache", 10 * 1024**3)
+                if lt_config.cache
+                else None
+            ),
+            use_cache=lt_config.cache,
+            use_query_log=False,
+        )
+        export_config = ExportConfig(config)
+        export_config.directory = self.run_dir / "exports"
+        export_config.job_store = export_config.directory / "jobs.sqlite"
+        self.exports = ExportJobManager(export_config, self.executor)
+        self.comparison = PeriodComparison(lt_config.table_name, executor=self.executor)
+
+        self.results: List[dict] = []
+        self._results_lock = threading.Lock()
+
+    def _random_builder(self, rng: random.Random, use_limit="default"):
+        builder = QueryBuilder(self.lt_config.table_name, use_limit=use_limit)
+        for column in rng.sample(
+            self.string_columns, k=min(rng.randint(1, 3), len(self.string_columns))
+        ):
+            values = self.filters[column]
+            builder.add_condition(
+                column,
+                "string",
+                "IN",
+                rng.sample(values, k=min(rng.randint(1, 3), len(values))),
+            )
+        start, end = self._random_period(rng)
+        builder.add_condition(
+            "DATEBAYAR", "datetime", "", [start.isoformat(), end.isoformat()]
+        )
+        return builder
+
+    def _random_period(self, rng: random.Random):
+        first_year, last_year = self.filters.get("DATEBAYAR", [2021, 2024])
+        year = rng.randint(first_year, last_year)
+        first_month = rng.randint(1, 12)
+        last_month = rng.randint(first_month, 12)
+        start = datetime.date(year, first_month, 1)
+        end = datetime.date(year + last_month // 12, last_month % 12 + 1, 1)
+        return start, end - datetime.timedelta(days=1)
+
+    def preview(self, rng: random.Random) -> int:
+        query, params = self._random_builder(rng).build_select()
+        return self.executor.fetch_arrow(query, params).num_rows
+
+    def count(self, rng: random.Random) -> int:
+        return self.executor.fetch_scalar(*self._random_builder(rng).build_count())
+
+    def aggregate(self, rng: random.Random) -> int:
+        builder = self._random_builder(rng)
+        dimensions = rng.sample(self.string_columns, k=rng.randint(0, 2))
+        table = self.comparison.compare(
+            builder,
+            dimensions,
+            self._random_period(rng),
+            mode=rng.choice(["prior", "year"]),
+        )
+        return table.num_rows
+
+    def export(self, rng: random.Random) -> int:
+        query, params = self._random_builder(rng, use_limit="none").build_select()
+        job = self.exports.submit(
+            query, params, rng.choice(self.lt_config.export_formats)
+        )
+        deadline = time.monotonic() + self.lt_config.export_timeout
+        while job["status"] not in (JOB_DONE, JOB_FAILED):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Export job {job['id']} still {job['status']}")
+            time.sleep(0.1)
+            job = self.exports.get(job["id"])
+        if job["status"] == JOB_FAILED:
+            raise RuntimeError(job["error"])
+        return Path(job["path"]).stat().st_size
+
+    def _session(self, session: int, started: float, deadline: float):
+        set_session(f"loadtest-{session}")
+        rng = random.Random(self.lt_config.seed * 1000 + session)
+        operations = [op for op in OPERATIONS if self.lt_config.mix.get(op, 0) > 0]
+        weights = [self.lt_config.mix[op] for op in operations]
+
+        delay = started + self.lt_config.ramp_up * session / self.lt_config.sessions
+        time.sleep(max(delay - time.monotonic(), 0))
+        while time.monotonic() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            result = {"session": session, "operation": operation, "error": None}
+            begin = time.perf_counter()
+            try:
+                result["size"] = getattr(self, operation)(rng)
+                result["status"] = "ok"
+            except AdmissionRejected as e:
+                result["status"], result["error"] = "rejected", str(e)
+            except Exception as e:
+                result["status"] = "error"
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["latency"] = time.perf_counter() - begin
+            result["finished"] = time.monotonic() - started
+            with self._results_lock:
+                self.results.append(result)
+
+            if self.lt_config.think_time > 0:
+                time.sleep(rng.expovariate(1 / self.lt_config.think_time))
+
+    def run(self) -> dict:
+        """Run all sessions for the configured duration and return the report"""
+        started = time.monotonic()
+        deadline = started + self.lt_config.duration
+        threads = [
+            threading.Thread(
+                target=self._session,
+                args=(session, started, deadline),
+                name=f"loadtest-{session}",
+            )
+            for session in range(self.lt_config.sessions)
+        ]
+        with MemorySampler(self.con) as memory:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.monotonic() - started
+        self.exports.pool.shutdown(wait=True)
+        return self.report(elapsed, memory)
+
+    def report(self, elapsed: float, memory: MemorySampler) -> dict:
+        operations = {}
+        for operation in OPERATIONS:
+            results = [r for r in self.results if r["operation"] == operation]
+            if results:
+                operations[operation] = _summarize(results, elapsed)
+
+        errors = {}
+        for result in self.results:
+            if result["error"]:
+                errors[result["error"]] = errors.get(result["error"], 0) + 1
+
+        return {
+            "started_at": time.time() - elapsed,
+            "target": self.lt_config.target,
+            "rows": _table_rows(self.con.cursor(), self.lt_config.table_name),
+            "sessions": self.lt_config.sessions,
+            "duration": self.lt_config.duration,
+            "mix": self.lt_config.mix,
+            "cache": self.lt_config.cache,
+            "elapsed": elapsed,
+            "overall": _summarize(self.results, elapsed),
+            "operations": operations,
+            "peak_rss_mb": memory.peak_rss / 1024**2,
+            "peak_duckdb_memory_mb": memory.peak_duckdb_memory / 1024**2,
+            "peak_duckdb_temp_mb": memory.peak_duckdb_temp / 1024**2,
+            "errors": dict(
+                sorted(errors.items(), key=lambda item: item[1], reverse=True)[:10]
+            ),
+        }
+
+
+def _summarize(results: List[dict], elapsed: float) -> dict:
+    latencies = sorted(r["latency"] for r in results if r["status"] == "ok")
+    failed = sum(r["status"] == "error" for r in results)
+    rejected = sum(r["status"] == "rejected" for r in results)
+    return {
+        "count": len(results),
+        "ok": len(latencies),
+        "errors": failed,
+        "rejected": rejected,
+        "error_rate": (failed + rejected) / len(results) if results else 0.0,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else None,
+    }
+
+
+def check(
+    report: dict,
+    max_p95: Optional[float] = None,
+    max_error_rate: Optional[float] = None,
+    baseline: Optional[dict] = None,
+    tolerance: float = 0.2,
+) -> List[str]:
+    """
+    Compare a report against absolute limits and a baseline report.
+
+    Args:
+        report: Output of LoadTest.run()
+        max_p95: Highest allowed overall p95 latency in seconds
+        max_error_rate: Highest allowed overall error rate, 0 to 1
+        baseline: An earlier report from the same scenario
+        tolerance: Allowed relative p95 increase or throughput drop vs baseline
+
+    Returns:
+        List[str]: One message per failed check, empty if all passed
+    """
+    failures = []
+    overall = report["overall"]
+    if max_p95 is not None and (overall["p95"] or 0) > max_p95:
+        failures.append(f"overall p95 {overall['p95']:.3f}s > {max_p95:.3f}s")
+    if max_error_rate is not None and overall["error_rate"] > max_error_rate:
+        failures.append(
+            f"error rate {overall['error_rate']:.2%} > {max_error_rate:.2%}"
+        )
+    if baseline is None:
+        return failures
+
+    for operation, stats in report["operations"].items():
+        before = baseline.get("operations", {}).get(operation)
+        if not before or not before["p95"] or stats["p95"] is None:
+            continue
+        if stats["p95"] > before["p95"] * (1 + tolerance):
+            failures.append(
+                f"{operation} p95 {stats['p95']:.3f}s vs baseline {before['p95']:.3f}s"
+            )
+    before = baseline["overall"]["throughput"]
+    if before and overall["throughput"] < before * (1 - tolerance):
+        failures.append(
+            f"throughput {overall['throughput']:.2f}/s vs baseline {before:.2f}/s"
+        )
+    return failures
+
+
+def format_report(report: dict) -> str:
+    def seconds(value):
+        return "-" if value is None else f"{value * 1000:9.1f}"
+
+    lines = [
+        f"{report['sessions']} sessions for {report['elapsed']:.1f}s against "
+        f"{report['rows']:,} rows ({report['target']})",
+        f"{'operation':<10} {'count':>7} {'err%':>6} {'ops/s':>7} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}",
+    ]
+    for name, stats in [*report["operations"].items(), ("overall", report["overall"])]:
+        lines.append(
+            f"{name:<10} {stats['count']:>7} {stats['error_rate'] * 100:>6.1f} "
+            f"{stats['throughput']:>7.2f} {seconds(stats['p50'])} "
+            f"{seconds(stats['p95'])} {seconds(stats['p99'])} {seconds(stats['max'])}"
+        )
+    lines.append(
+        f"peak RSS {report['peak_rss_mb']:.0f} MB, DuckDB memory "
+        f"{report['peak_duckdb_memory_mb']:.0f} MB, spilled "
+        f"{report['peak_duckdb_temp_mb']:.0f} MB"
+    )
+    for error, count in report["errors"].items():
+        lines.append(f"{count:>6} x {error}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Load-test the backend with concurrent synthetic sessions"
+    )
+    parser.add_argument("--config", default="config.toml")
+    parser.add_argument("--target", choices=["duckdb", "postgres"])
+    parser.add_argument("--rows", type=int)
+    parser.add_argument("--sessions", type=int)
+    parser.add_argument("--duration", type=float)
+    parser.add_argument("--think-time", type=float)
+    parser.add_argument("--cache", action="store_true", default=None)
+    parser.add_argument(
+        "--populate",
+        action="store_true",
+        help="Create the synthetic table on a postgres target if it is missing",
+    )
+    parser.add_argument("--max-p95", type=float)
+    parser.add_argument("--max-error-rate", type=float)
+    parser.add_argument("--baseline", type=Path, help="Report JSON to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    config = DatabaseManager.load_config(args.config)
+    lt_config = LoadTestConfig(config)
+    for name in ("target", "rows", "sessions", "duration", "think_time", "cache"):
+        if getattr(args, name) is not None:
+            setattr(lt_config, name, getattr(args, name))
+
+    con = open_target(config, lt_config, populate=args.populate)
+    load_test = LoadTest(config, lt_config, con)
+    report = load_test.run()
+
+    load_test.run_dir.mkdir(parents=True, exist_ok=True)
+    report_path = load_test.run_dir / "report.json"
+    report_path.write_text(json.dumps(report, indent=2, default=str))
+    print(format_report(report))
+    print(f"Report written to {report_path}")
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+    failures = check(
+        report, args.max_p95, args.max_error_rate, baseline, args.tolerance
+    )
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
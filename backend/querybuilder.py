@@ -8,6 +8,7 @@ class QueryBuilder:
         self.table_name = table_name
         self.conditions = []
         self.params = []
+        self.filters = []
         self.use_limit = use_limit
         self.custom_limit = None
         self.DEFAULT_LIMIT = 200
@@ -64,6 +65,15 @@ class QueryBuilder:
         for col_name, col_type, operator, value in zip(
             column_names, column_types, operators, values
         ):
+            # Structured copy for consumers that need more than the SQL text
+            self.filters.append(
+                {
+                    "column": col_name,
+                    "type": col_type.lower(),
+                    "operator": operator,
+                    "value": value,
+                }
+            )
             if col_type.lower() == "string":
                 if isinstance(value, list):
                     placeholders = ["?" for _ in value]
@@ -131,6 +141,7 @@ class QueryBuilder:
     def clear_conditions(self):
         self.conditions = []
         self.params = []
+        self.filters = []
 
 
 if __name__ == "__main__":
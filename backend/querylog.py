@@ -0,0 +1,278 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import List, Optional
+
+from .connection import DatabaseManager
+
+_session: ContextVar[Optional[str]] = ContextVar("query_session", default=None)
+
+
+def set_session(session_id: Optional[str]):
+    """Tag the queries run from the current thread/context with session_id"""
+    _session.set(session_id)
+
+
+def get_session() -> Optional[str]:
+    return _session.get()
+
+
+class QueryLogConfig:
+    def __init__(self, config):
+        querylog = config.get("querylog", {})
+        self.enabled = bool(querylog.get("enabled", False))
+        self.path = Path(querylog.get("path", "logs/slow_queries.jsonl"))
+        self.threshold_seconds = float(querylog.get("threshold_seconds", 2.0))
+        self.max_bytes = int(querylog.get("max_bytes", 10 * 1024 * 1024))
+        self.backup_count = int(querylog.get("backup_count", 5))
+        self.profile = bool(querylog.get("profile", True))
+
+
+def query_shape(query: str) -> str:
+    """
+    Reduce a query to its shape so runs with different filter values group
+    together: whitespace is collapsed, IN lists and literals become '?'.
+    """
+    shape = re.sub(r"\s+", " ", query).strip()
+    shape = re.sub(r"IN \((\s*\?\s*,?)+\)", "IN (?)", shape, flags=re.IGNORECASE)
+    shape = re.sub(r"'(?:[^']|'')*'", "?", shape)
+    shape = re.sub(r"\b\d+(\.\d+)?\b", "?", shape)
+    return shape
+
+
+def _operator_name(node) -> Optional[str]:
+    # DuckDB 1.0 writes name, 1.1 operator_type, later versions operator_name
+    return node.get("operator_name") or node.get("operator_type") or node.get("name")
+
+
+def _walk_operators(node, depth=0):
+    if _operator_name(node):
+        yield depth, node
+    for child in node.get("children", []):
+        yield from _walk_operators(child, depth + 1)
+
+
+def summarize_profile(profile: dict) -> dict:
+    """
+    Pull per-operator timings out of a DuckDB JSON profile.
+
+    Returns:
+        dict: latency, the flattened operators and the time spent in
+            Postgres scans
+    """
+    operators = []
+    postgres_scan_seconds = 0.0
+    for depth, node in _walk_operators(profile):
+        name = _operator_name(node).strip()
+        timing = node.get("operator_timing", node.get("timing", 0.0)) or 0.0
+        operators.append(
+            {
+                "depth": depth,
+                "name": name,
+                "timing": timing,
+                "cardinality": node.get(
+                    "operator_cardinality", node.get("cardinality")
+                ),
+            }
+        )
+        extra_info = json.dumps(node.get("extra_info", {}))
+        if "POSTGRES" in name.upper() or "POSTGRES_SCAN" in extra_info.upper():
+            postgres_scan_seconds += timing
+    return {
+        "latency": profile.get("latency", profile.get("timing")),
+        "operators": operators,
+        "postgres_scan_seconds": postgres_scan_seconds,
+    }
+
+
+class SlowQueryLog:
+    """
+    Records queries slower than a threshold, with their DuckDB profile.
+
+    Entries are JSON lines in a size-rotated file next to the app. When
+    profiling is on, each query runs with DuckDB's JSON profiler writing to
+    a scratch file, which is kept only if the query turns out to be slow.
+    """
+
+    _instance: Optional["SlowQueryLog"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        path,
+        threshold_seconds: float = 2.0,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5,
+        profile: bool = True,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.threshold_seconds = threshold_seconds
+        self.backup_count = backup_count
+        self.profile = profile
+
+        self.logger = logging.getLogger(f"{__name__}.{self.path}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(
+                self.path, maxBytes=max_bytes, backupCount=backup_count
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+    @classmethod
+    def instance(cls, config_file: str = "config.toml") -> Optional["SlowQueryLog"]:
+        """The process-wide log, or None if [querylog] is not enabled"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                log_config = QueryLogConfig(DatabaseManager(config_file).config)
+                if not log_config.enabled:
+                    return None
+                cls._instance = cls(
+                    log_config.path,
+                    log_config.threshold_seconds,
+                    log_config.max_bytes,
+                    log_config.backup_count,
+                    log_config.profile,
+                )
+            return cls._instance
+
+    def start(self, cur) -> dict:
+        """
+        Prepare a fresh cursor for a query and start its clock.
+
+        Returns:
+            dict: Handle to pass to finish()
+        """
+        handle = {"started": time.perf_counter(), "profile_path": None}
+        if self.profile:
+            fd, profile_path = tempfile.mkstemp(
+                prefix=".profile_", suffix=".json", dir=self.path.parent
+            )
+            os.close(fd)
+            cur.execute("SET enable_profiling = 'json'")
+            cur.execute(f"SET profiling_output = '{Path(profile_path).as_posix()}'")
+            handle["profile_path"] = profile_path
+        return handle
+
+    def finish(
+        self,
+        handle: dict,
+        query: str,
+        params=None,
+        kind: str = None,
+        error: BaseException = None,
+    ):
+        """Log the query if it ran longer than the threshold, failed or not"""
+        elapsed = time.perf_counter() - handle["started"]
+        profile_path = handle["profile_path"]
+        try:
+            if elapsed < self.threshold_seconds:
+                return
+            entry = {
+                "timestamp": time.time(),
+                "session": get_session(),
+                "kind": kind,
+                "elapsed": elapsed,
+                "query": query,
+                "params": list(params or []),
+                "shape": query_shape(query),
+                "error": f"{type(error).__name__}: {error}" if error else None,
+            }
+            profile = self._read_profile(profile_path)
+            if profile is not None:
+                entry.update(summarize_profile(profile))
+                entry["profile"] = profile
+            self.logger.info(json.dumps(entry, default=str))
+        finally:
+            if profile_path:
+                Path(profile_path).unlink(missing_ok=True)
+
+    @contextmanager
+    def capture(self, cur, query: str, params=None, kind: str = None):
+        """Time (and profile) the query run on cur inside the block"""
+        handle = self.start(cur)
+        try:
+            yield
+        except Exception as e:
+            self.finish(handle, query, params, kind, error=e)
+            raise
+        self.finish(handle, query, params, kind)
+
+    @staticmethod
+    def _read_profile(profile_path) -> Optional[dict]:
+        if not profile_path:
+            return None
+        try:
+            with open(profile_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def entries(self) -> List[dict]:
+        """All logged entries, oldest first, across rotated files"""
+        files = [
+            Path(f"{self.path}.{index}") for index in range(self.backup_count, 0, -1)
+        ] + [self.path]
+        entries = []
+        for file in files:
+            if not file.exists():
+                continue
+            with open(file, "r") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        return entries
+
+    def aggregate(self) -> List[dict]:
+        """
+        Group logged queries by shape.
+
+        Returns:
+            List[dict]: One row per shape, slowest total time first
+        """
+        shapes = {}
+        for entry in self.entries():
+            row = shapes.setdefault(
+                entry["shape"],
+                {
+                    "shape": entry["shape"],
+                    "count": 0,
+                    "errors": 0,
+                    "total_seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "postgres_scan_seconds": 0.0,
+                    "sessions": set(),
+                    "last_seen": 0.0,
+                },
+            )
+            row["count"] += 1
+            row["errors"] += bool(entry.get("error"))
+            row["total_seconds"] += entry["elapsed"]
+            row["max_seconds"] = max(row["max_seconds"], entry["elapsed"])
+            row["postgres_scan_seconds"] += entry.get("postgres_scan_seconds") or 0.0
+            if entry.get("session"):
+                row["sessions"].add(entry["session"])
+            row["last_seen"] = max(row["last_seen"], entry["timestamp"])
+
+        rows = []
+        for row in shapes.values():
+            row["mean_seconds"] = row["total_seconds"] / row["count"]
+            row["sessions"] = len(row["sessions"])
+            rows.append(row)
+        return sorted(rows, key=lambda row: row["total_seconds"], reverse=True)
+
+
+def get_query_log() -> Optional[SlowQueryLog]:
+    return SlowQueryLog.instance("config.toml")
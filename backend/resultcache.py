@@ -0,0 +1,347 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .connection import DatabaseManager
+
+
+class CacheConfig:
+    def __init__(self, config):
+        cache = config.get("cache", {})
+        self.enabled = bool(cache.get("enabled", False))
+        self.directory = Path(cache.get("directory", "cache"))
+        self.max_size_mb = int(cache.get("max_size_mb", 10240))
+        self.version_query = cache.get("version_query")
+        self.version_ttl = float(cache.get("version_ttl", 300))
+        self.lock_timeout = float(cache.get("lock_timeout", 1800))
+        self.evict_interval = float(cache.get("evict_interval", 300))
+
+
+class DataVersion:
+    """
+    A stamp that changes when the source data changes.
+
+    The stamp is the result of version_query, re-read at most every ttl
+    seconds. Without a version_query the stamp is constant and the cache
+    is only invalidated by hand.
+    """
+
+    def __init__(self, conn_factory: Callable, version_query: str = None, ttl=300):
+        self.conn_factory = conn_factory
+        self.version_query = version_query
+        self.ttl = ttl
+        self._stamp = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self) -> str:
+        if not self.version_query:
+            return "static"
+        with self._lock:
+            if self._stamp is None or time.time() - self._checked_at > self.ttl:
+                row = self.conn_factory().execute(self.version_query).fetchone()
+                self._stamp = json.dumps(row, default=str)
+                self._checked_at = time.time()
+            return self._stamp
+
+
+class ResultCache:
+    """
+    Content-addressed cache of query results stored as Parquet files.
+
+    Entries are keyed by a hash of the normalized SQL, its params and the
+    current data version, and live under one directory per data version.
+    The directory can sit on a volume shared by several app replicas: a
+    lock file per key makes sure only one of them computes a missing entry.
+
+    Writes add to a running size total instead of scanning the directory.
+    The directory is only scanned, and trimmed to LOW_WATER of the limit,
+    once the total passes max_size_bytes or every evict_interval seconds to
+    pick up what other replicas wrote.
+    """
+
+    LOW_WATER = 0.9
+
+    _instance: Optional["ResultCache"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        directory,
+        max_size_bytes: int,
+        data_version: Callable[[], str] = None,
+        lock_timeout: float = 1800,
+        evict_interval: float = 300,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+        self.data_version = data_version or (lambda: "static")
+        self.lock_timeout = lock_timeout
+        self.evict_interval = evict_interval
+        self._seen_version = None
+        self._size: Optional[int] = None
+        self._scanned_at = 0.0
+        self._size_lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls, config_file: str = "config.toml") -> Optional["ResultCache"]:
+        """The process-wide cache, or None if [cache] is not enabled"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                db_manager = DatabaseManager(config_file)
+                cache_config = CacheConfig(db_manager.config)
+                if not cache_config.enabled:
+                    return None
+                cls._instance = cls(
+                    cache_config.directory,
+                    cache_config.max_size_mb * 1024 * 1024,
+                    DataVersion(
+                        lambda: db_manager.connection.cursor(),
+                        cache_config.version_query,
+                        cache_config.version_ttl,
+                    ),
+                    cache_config.lock_timeout,
+                    cache_config.evict_interval,
+                )
+            return cls._instance
+
+    @staticmethod
+    def normalize_sql(query: str) -> str:
+        return re.sub(r"\s+", " ", query).strip().rstrip(";").strip()
+
+    def _version_dir(self, version: str) -> Path:
+        digest = hashlib.sha256(version.encode("utf-8")).hexdigest()[:16]
+        return self.directory / f"v_{digest}"
+
+    def key(self, query: str, params: Optional[List], version: str) -> str:
+        payload = json.dumps(
+            [self.normalize_sql(query), list(params or []), version], default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def entry_path(self, query: str, params: Optional[List] = None) -> Path:
+        version = self.data_version()
+        if version != self._seen_version:
+            # The data changed (or first use): results of older versions are stale
+            self._seen_version = version
+            self.invalidate()
+        key = self.key(query, params, version)
+        return self._version_dir(version) / key[:2] / f"{key}.parquet"
+
+    def lookup_path(self, query: str, params: Optional[List] = None):
+        """Path of the cached result if present, else None"""
+        path = self.entry_path(query, params)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get(self, query: str, params: Optional[List] = None) -> Optional[pa.Table]:
+        path = self.lookup_path(query, params)
+        if path is None:
+            return None
+        try:
+            return pq.read_table(path)
+        except FileNotFoundError:
+            # Evicted by another process between lookup and read
+            return None
+
+    def put(self, query: str, params: Optional[List], table: pa.Table) -> Path:
+        path = self.entry_path(query, params)
+        self._write(path, table)
+        self._added(path)
+        return path
+
+    def tee(
+        self,
+        query: str,
+        params: Optional[List],
+        reader: pa.RecordBatchReader,
+        max_bytes: Optional[int] = None,
+    ) -> pa.RecordBatchReader:
+        """
+        Pass the batches of reader through while writing them to the cache.
+
+        Only one batch is held at a time. The entry is stored once the stream
+        has been read to the end, and dropped if it is abandoned, fails or
+        grows past max_bytes (the whole cache size by default).
+        """
+        path = self.entry_path(query, params)
+        max_bytes = self.max_size_bytes if max_bytes is None else max_bytes
+
+        def batches():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.part")
+            writer = pq.ParquetWriter(temp_path, reader.schema, compression="zstd")
+            written, complete = 0, False
+            try:
+                for batch in reader:
+                    if writer is not None:
+                        written += batch.nbytes
+                        if written > max_bytes:
+                            writer.close()
+                            writer = None
+                        else:
+                            writer.write_batch(batch)
+                    yield batch
+                complete = True
+            finally:
+                if writer is not None:
+                    writer.close()
+                    if complete:
+                        os.replace(temp_path, path)
+                temp_path.unlink(missing_ok=True)
+            if writer is not None and complete:
+                self._added(path)
+
+        return pa.RecordBatchReader.from_batches(reader.schema, batches())
+
+    def get_or_compute(
+        self, query: str, params: Optional[List], compute: Callable[[], pa.Table]
+    ) -> pa.Table:
+        """
+        Return the cached result of query, computing and storing it if missing.
+
+        Concurrent callers for the same key, in this process or another
+        replica, wait for the first one instead of recomputing.
+        """
+        path = self.entry_path(query, params)
+        table = self._read(path)
+        if table is not None:
+            return table
+
+        with self._key_lock(path):
+            table = self._read(path)
+            if table is not None:
+                return table
+            table = compute()
+            self._write(path, table)
+        self._added(path)
+        return table
+
+    def _read(self, path: Path) -> Optional[pa.Table]:
+        try:
+            table = pq.read_table(path)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return table
+
+    @staticmethod
+    def _write(path: Path, table: pa.Table):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.part")
+        try:
+            pq.write_table(table, temp_path, compression="zstd")
+            os.replace(temp_path, path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+    @contextmanager
+    def _key_lock(self, path: Path, poll_interval: float = 0.2):
+        """Exclusive lock file next to the entry, shared across processes"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        lock_path = path.with_name(f"{path.name}.lock")
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    age = time.time() - lock_path.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                if age > self.lock_timeout:
+                    # The holder died without cleaning up
+                    lock_path.unlink(missing_ok=True)
+                    continue
+                time.sleep(poll_interval)
+        try:
+            os.write(fd, f"{os.getpid()}".encode("utf-8"))
+            os.close(fd)
+            yield
+        finally:
+            lock_path.unlink(missing_ok=True)
+
+    def _entries(self):
+        entries = []
+        for path in self.directory.glob("v_*/*/*.parquet"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _added(self, path: Path):
+        """Count a new entry, evicting once the cache may be over its limit"""
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+            due = (
+                self._size is None
+                or self._size > self.max_size_bytes
+                or time.time() - self._scanned_at > self.evict_interval
+            )
+        if due:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits LOW_WATER of
+        max_size_bytes, if it is over max_size_bytes.
+        """
+        if not self._evict_lock.acquire(blocking=False):
+            # Another thread is already scanning
+            return
+        try:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_size_bytes:
+                for _, size, path in entries:
+                    if total <= self.max_size_bytes * self.LOW_WATER:
+                        break
+                    path.unlink(missing_ok=True)
+                    total -= size
+            with self._size_lock:
+                self._size, self._scanned_at = total, time.time()
+        finally:
+            self._evict_lock.release()
+
+    def invalidate(self, all_versions: bool = False):
+        """
+        Drop cached results of old data versions, or everything.
+
+        Args:
+            all_versions: Also drop entries of the current data version
+        """
+        current = self._version_dir(self._seen_version or self.data_version())
+        for version_dir in self.directory.glob("v_*"):
+            if all_versions or version_dir != current:
+                shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    return ResultCache.instance("config.toml")
@@ -0,0 +1,375 @@
+import json
+import re
+import shutil
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .admission import QUERY_COUNT, QUERY_EXPORT, QUERY_PREVIEW, AdmissionRejected
+from .bitmapindex import SnapshotIndex
+from .connection import DatabaseManager
+from .executor import QueryExecutor
+from .getfilters import DataFilter
+from .querybuilder import QueryBuilder
+from .querylog import set_session
+from .typeahead import TypeaheadConfig
+
+ARROW_STREAM_MIME = "application/vnd.apache.arrow.stream"
+PARQUET_MIME = "application/vnd.apache.parquet"
+
+ALLOWED_OPERATORS = {"", "=", "<>", "!=", "<", "<=", ">", ">=", "IN"}
+ALLOWED_TYPES = {"string", "integer", "float", "decimal", "datetime"}
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class ServiceConfig:
+    def __init__(self, config):
+        service = config.get("service", {})
+        db = config["db"]
+        self.host = service.get("host", "127.0.0.1")
+        self.port = int(service.get("port", 8765))
+        self.table_name = service.get(
+            "table_name", f"db.{db['schema']}.{db['database']}"
+        )
+        self.batch_size = int(service.get("batch_size", 65536))
+        # Larger limits count as full results for admission control
+        self.preview_limit = int(service.get("preview_limit", 1000))
+
+
+class RequestError(ValueError):
+    """A malformed query request, answered with 400"""
+
+
+class _ChunkedWriter:
+    """File-like wrapper sending each write as an HTTP/1.1 chunk"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        if data:
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii"))
+            self.wfile.write(data)
+            self.wfile.write(b"\r\n")
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        if not self.closed:
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+            self.closed = True
+
+
+class QueryService:
+    """
+    Turns filter specs into QueryBuilder queries and runs them through the
+    shared executor, so callers reuse its connection, admission control and
+    result cache.
+
+    A request body looks like:
+
+        {
+            "conditions": {
+                "column_names": ["MAP", "DATEBAYAR"],
+                "column_types": ["string", "datetime"],
+                "operators": ["IN", ""],
+                "values": [["PPh 21"], ["2024-01-01", "2024-12-31"]]
+            },
+            "columns": ["ADMIN", "MAP", "NOMINAL"],
+            "limit": 1000,
+            "format": "arrow"
+        }
+
+    Everything except "conditions" is optional; without "limit" the full
+    result is returned.
+    """
+
+    def __init__(
+        self,
+        service_config: ServiceConfig,
+        filter_columns,
+        executor: QueryExecutor = None,
+        snapshot_index: SnapshotIndex = None,
+    ):
+        self.config = service_config
+        self.filter_columns = set(filter_columns)
+        self.executor = executor or QueryExecutor()
+        self.snapshot_index = snapshot_index
+
+    def _identifier(self, name: str) -> str:
+        if not isinstance(name, str) or not _IDENTIFIER.match(name):
+            raise RequestError(f"Invalid column name: {name!r}")
+        return name
+
+    def build(self, spec: dict) -> QueryBuilder:
+        """Validate a request spec and turn it into a QueryBuilder"""
+        if not isinstance(spec, dict):
+            raise RequestError("Request body must be a JSON object")
+
+        conditions = spec.get("conditions") or {}
+        if not isinstance(conditions, dict):
+            raise RequestError('"conditions" must be a JSON object')
+        column_names = conditions.get("column_names", [])
+        column_types = conditions.get("column_types", [])
+        operators = conditions.get("operators", [])
+        values = conditions.get("values", [])
+        if isinstance(column_names, str):
+            column_names, column_types = [column_names], [column_types]
+            operators, values = [operators], [values]
+        for key, value in (
+            ("column_names", column_names),
+            ("column_types", column_types),
+            ("operators", operators),
+            ("values", values),
+        ):
+            if not isinstance(value, list):
+                raise RequestError(f'"conditions.{key}" must be a list')
+        if not len(column_names) == len(column_types) == len(operators) == len(values):
+            raise RequestError("All condition lists must have the same length")
+
+        for name, col_type, operator in zip(column_names, column_types, operators):
+            if name not in self.filter_columns:
+                raise RequestError(f"Filtering on {name!r} is not allowed")
+            if str(col_type).lower() not in ALLOWED_TYPES:
+                raise RequestError(f"Unsupported column type {col_type!r}")
+            if str(operator).upper() not in ALLOWED_OPERATORS:
+                raise RequestError(f"Unsupported operator {operator!r}")
+
+        limit = spec.get("limit")
+        builder = QueryBuilder(
+            self.config.table_name, use_limit="none" if limit is None else "custom"
+        )
+        if limit is not None:
+            # bool is an int subclass, "limit": true would become LIMIT True
+            if isinstance(limit, bool) or not isinstance(limit, int) or limit < 0:
+                raise RequestError("limit must be a non-negative integer")
+            builder.set_custom_limit(limit)
+        if column_names:
+            try:
+                builder.add_condition(column_names, column_types, operators, values)
+            except ValueError as e:
+                raise RequestError(str(e))
+        return builder
+
+    def select(self, spec: dict) -> tuple[str, list, str]:
+        builder = self.build(spec)
+        columns = spec.get("columns")
+        if columns is not None:
+            if not isinstance(columns, list):
+                raise RequestError('"columns" must be a list')
+            columns = [f'"{self._identifier(column)}"' for column in columns]
+        query, params = builder.build_select(columns)
+        limit = spec.get("limit")
+        kind = (
+            QUERY_PREVIEW
+            if limit is not None and limit <= self.config.preview_limit
+            else QUERY_EXPORT
+        )
+        return query, list(params), kind
+
+    def count(self, spec: dict) -> int:
+        builder = self.build(spec)
+        if self.snapshot_index is not None:
+            count = self.snapshot_index.count(builder)
+            if count is not None:
+                return count
+        query, params = builder.build_count()
+        return self.executor.fetch_scalar(query, params, kind=QUERY_COUNT)
+
+    def prepare(self, spec: dict, result_format: str = "arrow") -> Callable:
+        """
+        Run the query for spec and return a function writing the result.
+
+        The query is admitted and executed here, before any response is
+        sent, so rejections and SQL errors can still become a clean error
+        reply. Warm results are read straight from the cache file; cold ones
+        stream from DuckDB batch by batch and fill the cache on the way.
+
+        Returns:
+            Callable: write(sink) sending the result in result_format
+        """
+        if result_format not in ("arrow", "parquet"):
+            raise RequestError("format must be 'arrow' or 'parquet'")
+        query, params, kind = self.select(spec)
+
+        cache = self.executor.cache
+        if cache is not None:
+            cached_file = self._open_cached(query, params)
+            if cached_file is not None:
+                if result_format == "parquet":
+                    return lambda sink: _copy_and_close(cached_file, sink)
+                reader = _read_parquet(cached_file, self.config.batch_size)
+                return lambda sink: _write_arrow(reader, sink)
+
+        reader = self.executor.fetch_batches(
+            query, params, self.config.batch_size, kind
+        )
+        if cache is not None:
+            reader = cache.tee(query, params, reader)
+        if result_format == "parquet":
+            return lambda sink: _write_parquet(reader, sink)
+        return lambda sink: _write_arrow(reader, sink)
+
+    def _open_cached(self, query: str, params: list):
+        # Opened now so a concurrent eviction cannot pull it away mid-copy
+        cached = self.executor.cache.lookup_path(query, params)
+        try:
+            return open(cached, "rb") if cached is not None else None
+        except FileNotFoundError:
+            return None
+
+
+def _copy_and_close(source, sink):
+    with source:
+        shutil.copyfileobj(source, sink)
+
+
+def _read_parquet(source, batch_size: int) -> pa.RecordBatchReader:
+    parquet_file = pq.ParquetFile(source)
+
+    def batches():
+        with source:
+            yield from parquet_file.iter_batches(batch_size=batch_size)
+
+    return pa.RecordBatchReader.from_batches(parquet_file.schema_arrow, batches())
+
+
+def _write_arrow(reader: pa.RecordBatchReader, sink):
+    with pa.ipc.new_stream(sink, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+
+def _write_parquet(reader: pa.RecordBatchReader, sink):
+    with pq.ParquetWriter(sink, reader.schema, compression="zstd") as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service: QueryService = None
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_spec(self) -> dict:
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # The body cannot be skipped, so the connection cannot be reused
+            self.close_connection = True
+            raise RequestError("Content-Length must be a non-negative integer")
+        try:
+            spec = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            raise RequestError("Request body is not valid JSON")
+        if not isinstance(spec, dict):
+            raise RequestError("Request body must be a JSON object")
+        if not isinstance(spec.get("format", "arrow"), str):
+            raise RequestError('"format" must be a string')
+        return spec
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        set_session(f"service:{self.client_address[0]}")
+        try:
+            spec = self._read_spec()
+            if self.path == "/count":
+                self._send_json(200, {"count": self.service.count(spec)})
+            elif self.path == "/query":
+                self._stream_result(spec)
+            else:
+                self._send_json(404, {"error": "Not found"})
+        except RequestError as e:
+            self._send_json(400, {"error": str(e)})
+        except AdmissionRejected as e:
+            self._send_json(503, {"error": str(e)})
+        except (
+            duckdb.BinderException,
+            duckdb.ParserException,
+            duckdb.ConversionException,
+        ) as e:
+            self._send_json(400, {"error": str(e)})
+        except duckdb.Error as e:
+            self._send_json(500, {"error": str(e)})
+
+    def _stream_result(self, spec: dict):
+        result_format = spec.get("format", "arrow")
+        write = self.service.prepare(spec, result_format)
+
+        self.send_response(200)
+        self.send_header(
+            "Content-Type",
+            PARQUET_MIME if result_format == "parquet" else ARROW_STREAM_MIME,
+        )
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        sink = _ChunkedWriter(self.wfile)
+        try:
+            write(sink)
+        except Exception as e:
+            # Headers are gone: drop the connection so the client sees a
+            # truncated stream instead of a clean end
+            self.log_error("Query failed mid-stream: %s", e)
+            self.close_connection = True
+            return
+        sink.close()
+
+
+def create_server(config_file: str = "config.toml") -> ThreadingHTTPServer:
+    config = DatabaseManager(config_file).config
+    service_config = ServiceConfig(config)
+    filter_columns = [
+        *(DataFilter(config_file).getfiltersTypes() or {}),
+        *TypeaheadConfig(config).columns,
+    ]
+
+    handler = type(
+        "BoundQueryRequestHandler",
+        (QueryRequestHandler,),
+        {
+            "service": QueryService(
+                service_config,
+                filter_columns,
+                snapshot_index=SnapshotIndex.instance(config_file),
+            )
+        },
+    )
+    return ThreadingHTTPServer((service_config.host, service_config.port), handler)
+
+
+def serve(
+    config_file: str = "config.toml", server: Optional[ThreadingHTTPServer] = None
+):
+    server = server or create_server(config_file)
+    host, port = server.server_address[:2]
+    print(f"Query service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve()
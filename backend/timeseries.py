@@ -0,0 +1,374 @@
+import datetime
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pyarrow as pa
+
+from .admission import QUERY_AGGREGATE, QUERY_REFRESH
+from .background import BackgroundRebuild
+from .connection import DatabaseManager
+from .executor import QueryExecutor
+
+GRAINS = {"day": "daily", "month": "monthly"}
+_ROLLUP_OPERATORS = {"", "=", "IN"}
+
+
+def _next_month(day: datetime.date) -> datetime.date:
+    return (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+class TimeSeriesConfig:
+    def __init__(self, config):
+        timeseries = config.get("timeseries", {})
+        db = config["db"]
+        self.path = Path(timeseries.get("path", "data/timeseries.duckdb"))
+        self.source_table = timeseries.get(
+            "source_table", f"db.{db['schema']}.{db['database']}"
+        )
+        self.date_column = timeseries.get("date_column", "DATEBAYAR")
+        self.value_column = timeseries.get("value_column", "NOMINAL")
+        self.dimensions = list(timeseries.get("dimensions", ["MAP", "ADMIN"]))
+        self.refresh_interval = float(timeseries.get("refresh_interval", 3600))
+        self.retry_interval = float(timeseries.get("retry_interval", 300))
+
+
+class TimeSeriesStore:
+    """
+    Daily and monthly sums of the value column per dimension, kept in a
+    local DuckDB file attached to the shared connection.
+
+    refresh() only re-aggregates source rows from the last stored day on
+    (the DATEBAYAR watermark), so its cost follows new data rather than
+    history. Rows back-dated before the watermark need a refresh(full=True).
+    """
+
+    CATALOG = "ts"
+
+    _instance: Optional["TimeSeriesStore"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, ts_config: TimeSeriesConfig, executor: QueryExecutor = None):
+        self.config = ts_config
+        # Rollups change on refresh, not with the source data version
+        self.executor = executor or QueryExecutor(use_cache=False)
+        self._attach_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._attached = False
+        self.refresher = BackgroundRebuild(
+            "timeseries-refresh", self.refresh, ts_config.retry_interval
+        )
+
+    @classmethod
+    def instance(cls, config_file: str = "config.toml") -> "TimeSeriesStore":
+        with cls._instance_lock:
+            if cls._instance is None:
+                config = DatabaseManager(config_file).config
+                cls._instance = cls(TimeSeriesConfig(config))
+            return cls._instance
+
+    @property
+    def dimensions(self) -> List[str]:
+        return self.config.dimensions
+
+    def _table(self, grain: str) -> str:
+        try:
+            return f"{self.CATALOG}.{GRAINS[grain]}"
+        except KeyError:
+            raise ValueError(f"grain must be one of {sorted(GRAINS)}")
+
+    def _dims_sql(self) -> str:
+        return ", ".join(f'"{dim}"' for dim in self.dimensions)
+
+    def _month_source(self, start, end):
+        """
+        Monthly rollup rows between start and end, with the months that start
+        or end cut through summed from the daily rollup instead.
+        """
+        start_cut = start is not None and start.day != 1
+        end_cut = end is not None and (end + datetime.timedelta(days=1)).day != 1
+        if not start_cut and not end_cut:
+            return self._table("month"), [], start, end
+        full_start = _next_month(start) if start_cut else start
+        if end is None:
+            full_stop = None
+        else:
+            full_stop = end.replace(day=1) if end_cut else _next_month(end)
+
+        in_full, full_params = [], []
+        if full_start is not None:
+            in_full.append("period >= ?")
+            full_params.append(full_start)
+        if full_stop is not None:
+            in_full.append("period < ?")
+            full_params.append(full_stop)
+        in_full = " AND ".join(in_full)
+
+        columns = f'{self._dims_sql()}, "{self.config.value_column}", "ROWS"'
+        source = f"""(
+            SELECT period, {columns} FROM {self._table("month")} WHERE {in_full}
+            UNION ALL
+            SELECT date_trunc('month', period)::DATE, {columns}
+            FROM {self._table("day")}
+            WHERE period BETWEEN ? AND ? AND NOT ({in_full})
+        )"""
+        params = [
+            *full_params,
+            start or datetime.date.min,
+            end or datetime.date.max,
+            *full_params,
+        ]
+        return source, params, None, None
+
+    def _ensure_attached(self):
+        if self._attached:
+            return
+        with self._attach_lock:
+            if self._attached:
+                return
+            self.config.path.parent.mkdir(parents=True, exist_ok=True)
+            cur = self.executor.cursor()
+            cur.execute(
+                f"ATTACH IF NOT EXISTS '{self.config.path.as_posix()}' AS {self.CATALOG}"
+            )
+            self._create_tables(cur)
+            stored = self._get_meta(cur, "dimensions")
+            if stored is not None and json.loads(stored) != self.dimensions:
+                # Dimensions changed in config.toml: the stored rollups are unusable
+                for table in GRAINS.values():
+                    cur.execute(f"DROP TABLE {self.CATALOG}.{table}")
+                cur.execute(f"DELETE FROM {self.CATALOG}.meta")
+                self._create_tables(cur)
+            self._set_meta(cur, "dimensions", json.dumps(self.dimensions))
+            self._attached = True
+
+    def _create_tables(self, cur):
+        dim_columns = ", ".join(f'"{dim}" VARCHAR' for dim in self.dimensions)
+        for table in GRAINS.values():
+            cur.execute(f"""CREATE TABLE IF NOT EXISTS {self.CATALOG}.{table} (
+                    period DATE, {dim_columns},
+                    "{self.config.value_column}" DECIMAL(38, 2), "ROWS" BIGINT
+                )""")
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {self.CATALOG}.meta (
+                key VARCHAR PRIMARY KEY, value VARCHAR
+            )""")
+
+    def _get_meta(self, cur, key: str) -> Optional[str]:
+        row = cur.execute(
+            f"SELECT value FROM {self.CATALOG}.meta WHERE key = ?", [key]
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, cur, key: str, value: str):
+        cur.execute(
+            f"INSERT OR REPLACE INTO {self.CATALOG}.meta VALUES (?, ?)", [key, value]
+        )
+
+    def watermark(self) -> Optional[datetime.date]:
+        """Last day held in the daily rollup, None if empty"""
+        self._ensure_attached()
+        row = (
+            self.executor.cursor()
+            .execute(f"SELECT max(period) FROM {self.CATALOG}.daily")
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def refreshed_at(self) -> Optional[float]:
+        self._ensure_attached()
+        value = self._get_meta(self.executor.cursor(), "refreshed_at")
+        return float(value) if value is not None else None
+
+    def refresh(self, full: bool = False) -> Optional[datetime.date]:
+        """
+        Bring the rollups up to date with the source table.
+
+        The last stored day is re-aggregated together with everything after
+        it, since it may have been partial at the previous refresh.
+
+        Args:
+            full: Rebuild both rollups from the whole source table
+
+        Returns:
+            datetime.date: The new watermark
+        """
+        self._ensure_attached()
+        with self._refresh_lock, self.executor.admission.admit(QUERY_REFRESH):
+            watermark = None if full else self.watermark()
+            date_col = f'"{self.config.date_column}"'
+            value_col = f'"{self.config.value_column}"'
+            dims = self._dims_sql()
+
+            cur = self.executor.cursor()
+            cur.execute("BEGIN TRANSACTION")
+            try:
+                if watermark is None:
+                    cur.execute(f"DELETE FROM {self.CATALOG}.daily")
+                    cur.execute(f"DELETE FROM {self.CATALOG}.monthly")
+                    source_filter, params = "", []
+                    month_start = datetime.date.min
+                else:
+                    cur.execute(
+                        f"DELETE FROM {self.CATALOG}.daily WHERE period >= ?",
+                        [watermark],
+                    )
+                    source_filter = f"WHERE {date_col} >= CAST(? AS TIMESTAMP)"
+                    params = [watermark.isoformat()]
+                    month_start = watermark.replace(day=1)
+                    cur.execute(
+                        f"DELETE FROM {self.CATALOG}.monthly WHERE period >= ?",
+                        [month_start],
+                    )
+
+                cur.execute(
+                    f"""INSERT INTO {self.CATALOG}.daily
+                        SELECT CAST({date_col} AS DATE) AS period, {dims},
+                            SUM({value_col}), COUNT(*)
+                        FROM {self.config.source_table} {source_filter}
+                        GROUP BY ALL""",
+                    params,
+                )
+                cur.execute(
+                    f"""INSERT INTO {self.CATALOG}.monthly
+                        SELECT date_trunc('month', period)::DATE, {dims},
+                            SUM({value_col}), SUM("ROWS")
+                        FROM {self.CATALOG}.daily
+                        WHERE period >= ?
+                        GROUP BY ALL""",
+                    [month_start],
+                )
+                self._set_meta(cur, "refreshed_at", str(time.time()))
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+        return self.watermark()
+
+    def refresh_if_stale(self, background: bool = False) -> bool:
+        """
+        Refresh when the last refresh is older than refresh_interval.
+
+        Args:
+            background: Refresh on a background thread and return at once,
+                so callers keep serving the current rollups meanwhile. A
+                failed background refresh is retried after retry_interval
+        """
+        refreshed_at = self.refreshed_at()
+        if (
+            refreshed_at is not None
+            and time.time() - refreshed_at < self.config.refresh_interval
+        ):
+            return False
+        if background:
+            return self.refresher.start()
+        else:
+            self.refresh()
+        return True
+
+    def covers(self, columns) -> bool:
+        """Whether filters/grouping on columns can be served from the rollups"""
+        return set(columns) <= set(self.dimensions)
+
+    def estimate_rows(self, filters) -> Optional[int]:
+        """
+        Rows matching QueryBuilder filters according to the daily rollup.
+
+        Rows loaded after the last refresh are missed, so this is an
+        estimate. None when a filter is not a date range or an IN/= on a
+        stored dimension, or when the rollups were never built.
+        """
+        dimension_filters, start, end = {}, None, None
+        for f in filters:
+            column, operator = f["column"], str(f["operator"]).upper()
+            if column == self.config.date_column and f["type"] == "datetime":
+                try:
+                    start, end = (
+                        datetime.date.fromisoformat(str(bound)[:10])
+                        for bound in f["value"]
+                    )
+                except (TypeError, ValueError):
+                    return None
+            elif (
+                f["type"] == "string"
+                and operator in _ROLLUP_OPERATORS
+                and self.covers([column])
+            ):
+                dimension_filters[column] = f["value"]
+            else:
+                return None
+        if self.refreshed_at() is None:
+            return None
+        table = self.trend("month", None, dimension_filters, start, end)
+        return sum(table.column("ROWS").to_pylist())
+
+    def trend(
+        self,
+        grain: str = "month",
+        group_by: Optional[List[str]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        start: Optional[datetime.date] = None,
+        end: Optional[datetime.date] = None,
+    ) -> pa.Table:
+        """
+        Sum of the value column per period, optionally split and filtered.
+
+        Args:
+            grain: "day" or "month"
+            group_by: Stored dimensions to split the series by
+            filters: {dimension: value or list of values}
+            start: First day to include; at month grain, a month cut by
+                start or end only sums its days inside the range
+            end: Last day to include
+
+        Returns:
+            pa.Table: period, the group_by columns, the value sum and ROWS
+
+        Example:
+            trend("month", ["MAP"], {"ADMIN": ["001", "002"]})
+        """
+        group_by = list(group_by or [])
+        filters = {col: value for col, value in (filters or {}).items() if value}
+        if not self.covers([*group_by, *filters]):
+            raise ValueError(
+                f"Time series only hold dimensions {self.dimensions}, "
+                f"got {sorted(set(group_by) | set(filters))}"
+            )
+        self._ensure_attached()
+
+        if grain == "month":
+            source, params, start, end = self._month_source(start, end)
+        else:
+            source, params = self._table(grain), []
+        conditions = []
+        for col, value in filters.items():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            conditions.append(f'"{col}" IN ({",".join("?" for _ in values)})')
+            params.extend(values)
+        if start is not None:
+            conditions.append("period >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("period <= ?")
+            params.append(end)
+
+        group_cols = "".join(f', "{col}"' for col in group_by)
+        query = (
+            f'SELECT period{group_cols}, SUM("{self.config.value_column}") '
+            f'AS "{self.config.value_column}", SUM("ROWS")::BIGINT AS "ROWS" '
+            f"FROM {source}"
+        )
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " GROUP BY ALL ORDER BY ALL"
+        return self.executor.fetch_arrow(query, params, kind=QUERY_AGGREGATE)
+
+
+def get_timeseries_store() -> TimeSeriesStore:
+    return TimeSeriesStore.instance("config.toml")
+
+
+if __name__ == "__main__":
+    store = get_timeseries_store()
+    print(f"Refreshed time series up to {store.refresh()}")
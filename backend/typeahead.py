@@ -0,0 +1,216 @@
+import bisect
+import heapq
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .admission import QUERY_REFRESH
+from .background import BackgroundRebuild
+from .connection import DatabaseManager
+from .executor import QueryExecutor
+
+NGRAM = 3
+
+
+class TypeaheadConfig:
+    def __init__(self, config):
+        typeahead = config.get("typeahead", {})
+        db = config["db"]
+        self.columns = list(typeahead.get("columns", []))
+        self.directory = Path(typeahead.get("directory", "data/typeahead"))
+        self.source_table = typeahead.get(
+            "source_table", f"db.{db['schema']}.{db['database']}"
+        )
+        self.refresh_interval = float(typeahead.get("refresh_interval", 86400))
+        self.limit = int(typeahead.get("limit", 20))
+        self.retry_interval = float(typeahead.get("retry_interval", 300))
+
+
+def normalize(value: str) -> str:
+    return " ".join(str(value).lower().split())
+
+
+def _ngrams(text: str):
+    return {text[i : i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class TypeaheadIndex:
+    """
+    In-memory prefix and trigram index over the distinct values of a column.
+
+    Values are kept sorted on their normalized form, so a prefix is a
+    binary-searched range. Substrings of three characters or more are
+    resolved through a trigram inverted index. Matches are ranked by how
+    many rows carry the value.
+    """
+
+    def __init__(self, values: List[str], counts: List[int]):
+        order = sorted(range(len(values)), key=lambda i: normalize(values[i]))
+        self.values = [values[i] for i in order]
+        self.counts = [counts[i] for i in order]
+        self.keys = [normalize(value) for value in self.values]
+
+        self.postings: Dict[str, array] = {}
+        for value_id, key in enumerate(self.keys):
+            for gram in _ngrams(key):
+                self.postings.setdefault(gram, array("I")).append(value_id)
+
+    @classmethod
+    def from_table(cls, table: pa.Table) -> "TypeaheadIndex":
+        return cls(table.column("value").to_pylist(), table.column("rows").to_pylist())
+
+    def __len__(self):
+        return len(self.values)
+
+    def _top(self, ids, limit: int) -> List[int]:
+        return heapq.nlargest(limit, ids, key=self.counts.__getitem__)
+
+    def search(self, text: str, limit: int = 20) -> List[str]:
+        """
+        Values starting with text, then values containing it, most frequent
+        first within each group.
+        """
+        query = normalize(text)
+        if not query:
+            return []
+
+        lo = bisect.bisect_left(self.keys, query)
+        hi = bisect.bisect_left(self.keys, query + "\uffff")
+        matches = self._top(range(lo, hi), limit)
+
+        if len(matches) < limit and len(query) >= NGRAM:
+            grams = sorted(_ngrams(query), key=lambda g: len(self.postings.get(g, ())))
+            candidates = set(self.postings.get(grams[0], ()))
+            for gram in grams[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(self.postings.get(gram, ()))
+            infix = (
+                value_id
+                for value_id in candidates
+                if not lo <= value_id < hi and query in self.keys[value_id]
+            )
+            matches += self._top(infix, limit - len(matches))
+
+        return [self.values[value_id] for value_id in matches]
+
+
+class TypeaheadSearch:
+    """
+    Typeahead indexes for the high-cardinality columns in [typeahead].
+
+    Distinct values and their row counts are pulled from the source once,
+    saved as Parquet so restarts skip the scan, and rebuilt in the
+    background after refresh_interval seconds.
+    """
+
+    _instance: Optional["TypeaheadSearch"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, typeahead_config: TypeaheadConfig, executor=None):
+        self.config = typeahead_config
+        # Rebuilt on a schedule, so bypass the result cache
+        self.executor = executor or QueryExecutor(use_cache=False)
+        self.indexes: Dict[str, TypeaheadIndex] = {}
+        self.built_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._rebuilds: Dict[str, BackgroundRebuild] = {}
+
+    @classmethod
+    def instance(cls, config_file: str = "config.toml") -> "TypeaheadSearch":
+        with cls._instance_lock:
+            if cls._instance is None:
+                config = DatabaseManager(config_file).config
+                cls._instance = cls(TypeaheadConfig(config))
+            return cls._instance
+
+    @property
+    def columns(self) -> List[str]:
+        return self.config.columns
+
+    def _index_path(self, column: str) -> Path:
+        return self.config.directory / f"{column}.parquet"
+
+    def _load(self, column: str) -> bool:
+        path = self._index_path(column)
+        if not path.exists():
+            return False
+        self.indexes[column] = TypeaheadIndex.from_table(pq.read_table(path))
+        self.built_at[column] = path.stat().st_mtime
+        return True
+
+    def build(self, column: str) -> TypeaheadIndex:
+        """Scan the distinct values of column and replace its index"""
+        if column not in self.columns:
+            raise ValueError(f"{column!r} is not a typeahead column")
+        table = self.executor.fetch_arrow(
+            f"""SELECT CAST("{column}" AS VARCHAR) AS value, COUNT(*) AS rows
+                FROM {self.config.source_table}
+                WHERE "{column}" IS NOT NULL
+                GROUP BY 1""",
+            kind=QUERY_REFRESH,
+        )
+        path = self._index_path(column)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.part")
+        pq.write_table(table, temp_path, compression="zstd")
+        temp_path.replace(path)
+
+        index = TypeaheadIndex.from_table(table)
+        with self._lock:
+            self.indexes[column] = index
+            self.built_at[column] = time.time()
+        return index
+
+    def _rebuild(self, column: str) -> BackgroundRebuild:
+        with self._lock:
+            if column not in self._rebuilds:
+                self._rebuilds[column] = BackgroundRebuild(
+                    f"typeahead-{column}",
+                    lambda: self.build(column),
+                    self.config.retry_interval,
+                )
+            return self._rebuilds[column]
+
+    def building(self, column: str) -> bool:
+        return self._rebuild(column).running
+
+    def error(self, column: str) -> Optional[str]:
+        """Why the last build of column failed, None if it did not"""
+        return self._rebuild(column).error
+
+    def index(self, column: str) -> Optional[TypeaheadIndex]:
+        """
+        The index for column, None until its first build has finished.
+
+        Builds run in the background, on first use and when the index is
+        older than refresh_interval, so searches never wait on the scan.
+        A failed build is retried after retry_interval.
+        """
+        if column not in self.indexes and not self._load(column):
+            self._rebuild(column).start()
+            return None
+        if time.time() - self.built_at[column] > self.config.refresh_interval:
+            self._rebuild(column).start()
+        return self.indexes[column]
+
+    def search(self, column: str, text: str, limit: int = None) -> List[str]:
+        index = self.index(column)
+        if index is None:
+            return []
+        return index.search(text, limit or self.config.limit)
+
+
+def get_typeahead() -> TypeaheadSearch:
+    return TypeaheadSearch.instance("config.toml")
+
+
+if __name__ == "__main__":
+    typeahead = get_typeahead()
+    for column in typeahead.columns:
+        print(f"{column}: {len(typeahead.build(column))} values indexed")
@@ -1,20 +1,56 @@
 import datetime
 import os
 import sys
+import uuid
 
+import pyarrow as pa
 import streamlit as st
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(project_root)
 
+from backend.bitmapindex import get_snapshot_index
+from backend.comparison import get_period_comparison
+from backend.executor import QueryExecutor
+from backend.exporters import (
+    DEFAULT_EXCEL_ROWS_PER_FILE,
+    EXCEL_MAX_ROWS,
+    EXPORT_FORMATS,
+    get_export_format,
+)
+from backend.exportjobs import JOB_DONE, JOB_FAILED, get_export_manager
 from backend.getfilters import DataFilter
-from backend.querybuilder import QueryBuilder, get_db_connection
+from backend.querybuilder import QueryBuilder
+from backend.querylog import set_session
+from backend.timeseries import get_timeseries_store
+from backend.typeahead import get_typeahead
 
 config_file = "config.toml"
 data_filter = DataFilter(config_file)
 filters = data_filter.getfilters()
 filters_types = data_filter.getfiltersTypes()
 db_config = data_filter.getDB()
+executor = QueryExecutor()
+typeahead = get_typeahead()
+snapshot_index = get_snapshot_index()
+
+if "query_executed" not in st.session_state:
+    st.session_state.query_executed = ""
+if "all_query" not in st.session_state:
+    st.session_state.all_query = ""
+if "params" not in st.session_state:
+    st.session_state.params = []
+if "row_count" not in st.session_state:
+    st.session_state.row_count = None
+if "row_estimate" not in st.session_state:
+    st.session_state.row_estimate = None
+if "count_query" not in st.session_state:
+    st.session_state.count_query = None
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+set_session(st.session_state.session_id)
+if "export_jobs" not in st.session_state:
+    st.session_state.export_jobs = []
 
 st.set_page_config(
     page_title="Jaktim Data Explorer",
@@ -66,20 +102,13 @@ st.markdown(
 )
 
 
-def handle_download():
-    with st.spinner("Preparing download..."):
-        st.session_state.csv_data = runQuery(conn, all_query, params).to_csv(
-            index=False
-        )
-        st.session_state.is_downloading = True
-
-
 def getDataFilter():
     column_names = []
     column_types = []
     filter_values = []
 
-    for key, value in st.session_state.items():
+    for key in filters_types.keys():
+        value = st.session_state.get(key, [])
         if len(value) > 0:
             column_names.append(key)
             column_types.append(filters_types[key])
@@ -89,6 +118,13 @@ def getDataFilter():
             else:
                 filter_values.append(value)
 
+    for key in typeahead.columns:
+        value = st.session_state.get(f"typeahead_selected_{key}", [])
+        if len(value) > 0:
+            column_names.append(key)
+            column_types.append("string")
+            filter_values.append(value)
+
     filters_operator = [
         "IN" if coltype == "string" else "" if coltype == "datetime" else "="
         for coltype in column_types
@@ -96,14 +132,189 @@ def getDataFilter():
     return column_names, column_types, filters_operator, filter_values
 
 
-def runQuery(conn, query, params):
-    return conn.execute(query, params).fetchdf()
+def keepTypeaheadSelection(key):
+    st.session_state[f"typeahead_selected_{key}"] = st.session_state[f"typeahead_{key}"]
+
+
+def typeaheadFilter(key):
+    # The multiselect is recreated whenever its options change, so the
+    # selection lives in its own session-state entry and is fed back as default
+    selected = st.session_state.get(f"typeahead_selected_{key}", [])
+    text = st.text_input(f"Search {key}", placeholder="Type to search")
+    matches = typeahead.search(key, text) if text else []
+    if typeahead.index(key) is None:
+        if typeahead.error(key):
+            st.caption(f"Search index for {key} failed: {typeahead.error(key)}")
+        else:
+            st.caption(f"Search index for {key} is building...")
+    st.multiselect(
+        label=key,
+        placeholder="Choose one or more",
+        options=list(dict.fromkeys([*selected, *matches])),
+        default=selected,
+        key=f"typeahead_{key}",
+        on_change=keepTypeaheadSelection,
+        args=(key,),
+    )
+
+
+def runQuery(query, params):
+    return executor.fetch_arrow(query, params)
+
+
+def showTrend():
+    store = get_timeseries_store()
+    store.refresh_if_stale(background=True)
+    if store.refreshed_at() is None:
+        if store.refresher.error:
+            st.warning(f"Trend data could not be built: {store.refresher.error}")
+        else:
+            st.info("Trend data is being built for the first time, check back shortly")
+        return
+
+    column_names, column_types, _, filters_value = getDataFilter()
+    trend_filters, start, end, ignored = {}, None, None, []
+    for col, coltype, value in zip(column_names, column_types, filters_value):
+        if coltype == "datetime":
+            start = datetime.date.fromisoformat(value[0][:10])
+            end = datetime.date.fromisoformat(value[-1][:10])
+        elif store.covers([col]):
+            trend_filters[col] = value
+        else:
+            ignored.append(col)
+
+    split_by = st.selectbox("Split trend by", options=[None] + store.dimensions)
+    trend = store.trend(
+        "month", [split_by] if split_by else None, trend_filters, start, end
+    )
+    value_column = store.config.value_column
+    trend = trend.set_column(
+        trend.schema.get_field_index(value_column),
+        value_column,
+        trend[value_column].cast(pa.float64()),
+    )
+    st.line_chart(trend, x="period", y=value_column, color=split_by)
+    if ignored:
+        st.caption(f"The trend ignores filters on {', '.join(ignored)}")
+
+
+def showComparison():
+    column_names, column_types, filters_operator, filters_value = getDataFilter()
+    builder = QueryBuilder(f"db.{db_config['schema']}.{db_config['database']}")
+    builder.add_condition(column_names, column_types, filters_operator, filters_value)
+    dates = [
+        value
+        for coltype, value in zip(column_types, filters_value)
+        if coltype == "datetime"
+    ]
+    if not dates:
+        st.caption("Pick a date range to compare it with the previous period")
+        return
+
+    col1, col2 = st.columns(2)
+    with col1:
+        mode = st.radio(
+            "Compare with",
+            options=["prior", "year"],
+            format_func={
+                "prior": "Previous period",
+                "year": "Same period last year",
+            }.get,
+            horizontal=True,
+        )
+    with col2:
+        dimensions = st.multiselect(
+            "Compare by",
+            options=[key for key, type in filters_types.items() if type == "string"],
+        )
+    current = (
+        datetime.date.fromisoformat(dates[0][0][:10]),
+        datetime.date.fromisoformat(dates[0][-1][:10]),
+    )
+    with st.spinner("Comparing periods..."):
+        comparison = get_period_comparison().compare(
+            builder, dimensions, current, mode=mode
+        )
+    st.dataframe(comparison, use_container_width=True, hide_index=True)
 
 
-@st.cache_data
-def downloadCSV(conn, all_query, params):
-    file = conn.execute(all_query, params).fetchdf().to_csv(index=False)
-    return file
+def countRows():
+    with st.spinner("Counting rows..."):
+        st.session_state.row_count = executor.fetch_scalar(
+            *st.session_state.count_query
+        )
+
+
+def estimateRows(builder, query, params):
+    """A cheap row estimate for the default export format, None if unknown"""
+    estimate = get_timeseries_store().estimate_rows(builder.filters)
+    if estimate is None:
+        estimate = executor.estimate_rows(query, params)
+    return estimate
+
+
+def submitExport(file_format, options=None):
+    job = get_export_manager().submit(
+        st.session_state.all_query, st.session_state.params, file_format, options
+    )
+    if job["id"] not in st.session_state.export_jobs:
+        st.session_state.export_jobs.insert(0, job["id"])
+
+
+def prepareDownload(job_id):
+    st.session_state.download_job = job_id
+
+
+def exportJobsPanel():
+    st.subheader("Exports")
+    manager = get_export_manager()
+    in_flight = []
+    for job_id in st.session_state.export_jobs:
+        job = manager.get(job_id)
+        if job is None:
+            continue
+        created = datetime.datetime.fromtimestamp(job["created_at"])
+        label = f"{created:%Y-%m-%d %H:%M:%S} · {job['file_format']} · {job['status']}"
+        if job["status"] == JOB_DONE and os.path.exists(job["path"]):
+            export_format = get_export_format(job["file_format"])
+            if st.session_state.get("download_job") != job_id:
+                # Streamlit loads download data into memory, so only the
+                # export the user asked for is read, once
+                st.button(
+                    f"Prepare download ({label})",
+                    on_click=prepareDownload,
+                    args=(job_id,),
+                    key=f"prepare_{job_id}",
+                )
+                continue
+            with open(job["path"], "rb") as f:
+                st.download_button(
+                    label=f"Download ({label})",
+                    data=f,
+                    file_name=f"all_rows_{created:%Y%m%d_%H%M%S}.{export_format['extension']}",
+                    mime=export_format["mime"],
+                    key=f"download_{job_id}",
+                    on_click=prepareDownload,
+                    args=(None,),
+                )
+        elif job["status"] == JOB_FAILED:
+            st.error(f"{label}: {job['error']}")
+        else:
+            in_flight.append(job_id)
+    if in_flight:
+        exportJobsProgress(in_flight)
+
+
+@st.fragment(run_every="5s")
+def exportJobsProgress(job_ids):
+    """Poll the running exports; rerun the page once one of them finishes"""
+    manager = get_export_manager()
+    for job_id in job_ids:
+        job = manager.get(job_id)
+        if job is None or job["status"] in (JOB_DONE, JOB_FAILED):
+            st.rerun()
+        created = datetime.datetime.fromtimestamp(job["created_at"])
+        st.info(f"{created:%Y-%m-%d %H:%M:%S} · {job['file_format']} · {job['status']}")
 
 
 with st.sidebar:
@@ -135,6 +346,8 @@ with st.sidebar:
                     format="YYYY-MM-DD",
                     on_change=None,
                 )
+    for key in typeahead.columns:
+        typeaheadFilter(key)
     querydata = st.button(label="Apply", type="primary", use_container_width=True)
 
 if querydata:
@@ -151,45 +364,101 @@ if querydata:
         # builder.set_custom_limit(10)
         query, params = builder.build_select()
 
-        conn = get_db_connection()
-
-        result = conn.execute(query, params).fetchdf()
+        result = row_count = None
+        if snapshot_index is not None:
+            result = snapshot_index.preview(builder)
+            row_count = snapshot_index.count(builder)
+        if result is None:
+            result = runQuery(query, params)
+        if row_count is None and result.num_rows < builder.DEFAULT_LIMIT:
+            # The preview already holds every matching row
+            row_count = result.num_rows
         all_query = query.replace("LIMIT 200", "").strip()
         # sumquery = all_query.replace("*", """SUM("NOMINAL")"TOTAL" """)
 
-        if "query_executed" not in st.session_state:
-            st.session_state.query_executed = ""
-        if all_query not in st.session_state:
-            st.session_state.all_query = ""
-        if "params" not in st.session_state:
-            st.session_state.params = []
-
         st.title("Sampling Data")
         st.dataframe(result, use_container_width=True, hide_index=True)
-        st.success("Data loaded successfully!")
+        if row_count is None:
+            st.success(
+                f"Data loaded successfully! Showing the first {result.num_rows:,} matching rows"
+            )
+        else:
+            st.success(f"Data loaded successfully! {row_count:,} matching rows")
+        if snapshot_index is not None and snapshot_index.built_at is not None:
+            snapshot_time = datetime.datetime.fromtimestamp(snapshot_index.built_at)
+            st.caption(f"Snapshot index built at {snapshot_time:%Y-%m-%d %H:%M}")
 
         st.session_state.all_query = all_query
+        st.session_state.row_count = row_count
+        st.session_state.row_estimate = (
+            estimateRows(builder, all_query, params) if row_count is None else None
+        )
+        st.session_state.count_query = builder.build_count()
         st.session_state.params = params
         st.session_state.query_executed = "Yes"
 
-    if st.session_state.query_executed == "Yes":
-        tobedownload = st.radio("Prepare data for download", options=["No", "Yes"])
-
-        if tobedownload == "Yes":
-            if st.session_state.csv_data is None:
-                with st.spinner("Preparing download..."):
-                    st.session_state.csv_data = downloadCSV(
-                        conn, st.session_state.all_query, st.session_state.params
-                    )
-
-            st.download_button(
-                label="Click here if download doesn't start automatically",
-                file_name=f"all_rows_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                data=st.session_state.csv_data,
-                mime="text/csv",
-                type="primary",
-                help="Download may take a few seconds to prepare",
+if st.session_state.query_executed == "Yes":
+    format_options = list(EXPORT_FORMATS)
+    row_count = st.session_state.row_count
+    if row_count is None:
+        # Exact counts cost a second scan, so they only run when asked for
+        st.button("Count matching rows", on_click=countRows)
+        format_options.remove("xlsx")
+        st.caption("Count the matching rows to pick a single-file xlsx export")
+    elif row_count > EXCEL_MAX_ROWS - 1:
+        # One sheet holds EXCEL_MAX_ROWS rows including the header
+        format_options.remove("xlsx")
+        st.caption(
+            f"{row_count:,} rows do not fit one Excel sheet, use xlsx_zip for Excel"
+        )
+    else:
+        st.caption(f"{row_count:,} matching rows")
+    if row_count is None and st.session_state.row_estimate is not None:
+        st.caption(f"About {st.session_state.row_estimate:,} matching rows")
+    suggested_format = get_export_manager().suggest_format(
+        row_count if row_count is not None else st.session_state.row_estimate
+    )
+    export_format = st.radio(
+        "Export format",
+        options=format_options,
+        index=format_options.index(suggested_format),
+        horizontal=True,
+        help="Defaults to a compressed or columnar format for large results",
+    )
+    export_options = None
+    if export_format == "xlsx_zip":
+        col1, col2 = st.columns(2)
+        with col1:
+            rows_per_file = st.number_input(
+                "Rows per file",
+                min_value=1000,
+                max_value=EXCEL_MAX_ROWS - 1,
+                value=DEFAULT_EXCEL_ROWS_PER_FILE,
+                step=50000,
             )
-
-        with st.expander("Query"):
-            st.write(st.session_state.all_query)
+        with col2:
+            split_by = st.selectbox(
+                "Split files by",
+                options=[None]
+                + [key for key, type in filters_types.items() if type == "string"],
+            )
+        export_options = {"rows_per_file": rows_per_file, "split_by": split_by}
+    st.button(
+        "Export all rows",
+        on_click=submitExport,
+        args=(export_format, export_options),
+        type="primary",
+        help="The export runs in the background and is listed below when ready",
+    )
+
+    with st.expander("Query"):
+        st.write(st.session_state.all_query)
+
+    if st.toggle("Show monthly trend"):
+        showTrend()
+
+    if st.toggle("Compare with previous period"):
+        showComparison()
+
+if st.session_state.export_jobs:
+    exportJobsPanel()
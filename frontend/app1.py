@@ -7,8 +7,9 @@ import streamlit as st
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(project_root)
 
+from backend.executor import QueryExecutor, table_to_csv
 from backend.getfilters import DataFilter
-from backend.querybuilder import QueryBuilder, get_db_connection
+from backend.querybuilder import QueryBuilder
 
 # Initialize session state variables
 if "csv_data" not in st.session_state:
@@ -27,6 +28,7 @@ data_filter = DataFilter(config_file)
 filters = data_filter.getfilters()
 filters_types = data_filter.getfiltersTypes()
 db_config = data_filter.getDB()
+executor = QueryExecutor()
 
 st.set_page_config(
     page_title="Jaktim Data Explorer",
@@ -81,8 +83,8 @@ st.markdown(
 
 
 @st.cache_data
-def downloadCSV(conn, all_query, params):
-    return conn.execute(all_query, params).fetchdf().to_csv(index=False)
+def downloadCSV(all_query, params):
+    return table_to_csv(executor.fetch_arrow(all_query, params))
 
 
 def getDataFilter():
@@ -164,8 +166,7 @@ if querydata:
         )
         query, params = builder.build_select()
 
-        conn = get_db_connection()
-        result = conn.execute(query, params).fetchdf()
+        result = executor.fetch_arrow(query, params)
         all_query = query.replace("LIMIT 200", "").strip()
 
         st.title("Sampling Data")
@@ -186,9 +187,8 @@ if st.session_state.query_executed == "Yes":
     if st.session_state.download_prepared:
         if st.session_state.csv_data is None:
             with st.spinner("Preparing download..."):
-                conn = get_db_connection()
                 st.session_state.csv_data = downloadCSV(
-                    conn, st.session_state.all_query, st.session_state.params
+                    st.session_state.all_query, st.session_state.params
                 )
 
         st.download_button(+6
@@ -3,34 +3,23 @@ from pathlib import Path
 
 import streamlit as st
 
+from backend.exporters import export_query, get_export_format
 
-def export_duckdb_data(conn, query, file_format="xlsx"):
+
+def export_duckdb_data(conn, query, file_format="xlsx", params=None):
     """Export data using DuckDB's native COPY command"""
     # Create a temporary directory that will be automatically cleaned up
     with tempfile.TemporaryDirectory() as temp_dir:
-        # Create full file path
-        temp_file = Path(temp_dir) / f"exported_data.{file_format}"
-
-        # Construct and execute COPY command based on format
-        if file_format == "xlsx":
-            copy_query = f"""COPY ({query}) TO '{temp_file}' 
-                           WITH (FORMAT EXCEL)"""
-            mime_type = (
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
-        elif file_format == "csv":
-            copy_query = f"""COPY ({query}) TO '{temp_file}'
-                           WITH (HEADER TRUE, DELIMITER ',')"""
-            mime_type = "text/csv"
-
-        # Execute the COPY command
-        conn.execute(copy_query)
+        export_format = get_export_format(file_format)
+        temp_file = Path(temp_dir) / f"exported_data.{export_format['extension']}"
+
+        export_query(conn, query, params, temp_file, file_format)
 
         # Read the file into memory
         with open(temp_file, "rb") as f:
             data = f.read()
 
-        return data, mime_type
+        return data, export_format["mime"]
 
 
 def create_duckdb_download_button(
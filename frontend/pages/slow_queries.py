@@ -0,0 +1,65 @@
+import datetime
+import os
+import sys
+
+import pyarrow as pa
+import streamlit as st
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.append(project_root)
+
+from backend.querylog import get_query_log
+
+st.set_page_config(
+    page_title="Slow Queries", layout="wide", page_icon="./assets/djp.ico"
+)
+st.title("Slow Queries")
+
+query_log = get_query_log()
+if query_log is None:
+    st.info("The slow-query log is disabled, enable it under [querylog] in config.toml")
+    st.stop()
+
+st.caption(f"Queries slower than {query_log.threshold_seconds:g}s, grouped by shape")
+shapes = query_log.aggregate()
+if not shapes:
+    st.info("No slow queries logged yet")
+    st.stop()
+
+for row in shapes:
+    row["last_seen"] = datetime.datetime.fromtimestamp(row["last_seen"])
+st.dataframe(
+    pa.Table.from_pylist(shapes).select(
+        [
+            "count",
+            "errors",
+            "total_seconds",
+            "mean_seconds",
+            "max_seconds",
+            "postgres_scan_seconds",
+            "sessions",
+            "last_seen",
+            "shape",
+        ]
+    ),
+    use_container_width=True,
+    hide_index=True,
+)
+
+shape = st.selectbox("Inspect shape", options=[row["shape"] for row in shapes])
+runs = [entry for entry in query_log.entries() if entry["shape"] == shape]
+slowest = max(runs, key=lambda entry: entry["elapsed"])
+
+st.subheader(f"Slowest run: {slowest['elapsed']:.2f}s")
+st.code(slowest["query"], language="sql")
+st.write({"params": slowest["params"], "session": slowest["session"]})
+if slowest.get("error"):
+    st.error(slowest["error"])
+if slowest.get("operators"):
+    st.dataframe(
+        pa.Table.from_pylist(slowest["operators"]),
+        use_container_width=True,
+        hide_index=True,
+    )
+    with st.expander("Raw DuckDB profile"):
+        st.json(slowest["profile"])
@@ -0,0 +1,65 @@
+from backend.querylog import query_shape, summarize_profile
+
+# Trimmed from a DuckDB 1.1.3 JSON profile of a filtered count over Postgres
+PROFILE_1_1 = {
+    "query_name": 'SELECT COUNT(*) FROM db.public.ppmpkm WHERE "MAP" IN (?)',
+    "latency": 2.5,
+    "rows_returned": 1,
+    "extra_info": {},
+    "children": [
+        {
+            "operator_type": "UNGROUPED_AGGREGATE",
+            "operator_timing": 0.1,
+            "operator_cardinality": 1,
+            "extra_info": {"Aggregates": "count_star()"},
+            "children": [
+                {
+                    "operator_type": "TABLE_SCAN",
+                    "operator_timing": 2.25,
+                    "operator_cardinality": 1200,
+                    "extra_info": {"Function": "POSTGRES_SCAN", "Filters": "MAP='x'"},
+                    "children": [],
+                }
+            ],
+        }
+    ],
+}
+
+
+def test_summarize_profile_reads_duckdb_1_1_operator_type():
+    summary = summarize_profile(PROFILE_1_1)
+
+    assert summary["latency"] == 2.5
+    assert [(op["depth"], op["name"]) for op in summary["operators"]] == [
+        (1, "UNGROUPED_AGGREGATE"),
+        (2, "TABLE_SCAN"),
+    ]
+    assert summary["operators"][1]["timing"] == 2.25
+    assert summary["operators"][1]["cardinality"] == 1200
+    assert summary["postgres_scan_seconds"] == 2.25
+
+
+def test_summarize_profile_reads_operator_name():
+    profile = {
+        "latency": 1.0,
+        "children": [
+            {
+                "operator_name": "POSTGRES_SCAN ",
+                "operator_type": "TABLE_SCAN",
+                "operator_timing": 0.75,
+                "operator_cardinality": 10,
+                "children": [],
+            }
+        ],
+    }
+
+    summary = summarize_profile(profile)
+
+    assert summary["operators"][0]["name"] == "POSTGRES_SCAN"
+    assert summary["postgres_scan_seconds"] == 0.75
+
+
+def test_query_shape_groups_filter_values():
+    assert query_shape(
+        "SELECT *\n FROM t WHERE a IN (?, ?, ?) AND b = 'x' LIMIT 200"
+    ) == ("SELECT * FROM t WHERE a IN (?) AND b = ? LIMIT ?")